@@ -0,0 +1,309 @@
+#!/bin/python
+# coding: utf-8
+
+# Micro-benchmarks for the models in models.py.
+#
+# These run on random token ids (no data needed), with the vocabulary size of
+# Penn Treebank, and print the throughput of one training step (forward +
+# backward) in tokens per second.
+#
+# Usage:
+#    python benchmark.py --bench output
+#    python benchmark.py --bench attention
+#    python benchmark.py --bench blockwise
+#    python benchmark.py --bench checkpoint
+#    python benchmark.py --bench sgd
+
+import argparse
+import math
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models import RNN, GRU, MultiHeadedAttention, causal_mask_bias
+from models import blockwise_attention, make_model, Batch
+from sgd import clipped_sgd_step
+
+parser = argparse.ArgumentParser(description='Benchmarks for the PTB language models')
+parser.add_argument('--bench', type=str, default='output',
+                    help='which benchmark to run; output, attention, blockwise, checkpoint, sgd')
+parser.add_argument('--vocab_size', type=int, default=10000,
+                    help='size of the vocabulary')
+parser.add_argument('--num_iters', type=int, default=10,
+                    help='number of timed iterations per configuration')
+parser.add_argument('--seed', type=int, default=1111,
+                    help='random seed')
+
+# (model, emb_size, hidden_size, seq_len, batch_size, num_layers):
+# the ptb-lm.py defaults, and the 1500-hidden settings of Problem 4.1
+CONFIGS = [
+    ('RNN', 200, 200, 35, 20, 2),
+    ('GRU', 200, 200, 35, 20, 2),
+    ('RNN', 200, 1500, 35, 20, 2),
+    ('GRU', 200, 1500, 35, 20, 2),
+]
+
+if torch.cuda.is_available():
+    device = torch.device("cuda")
+else:
+    device = torch.device("cpu")
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def per_step_output_forward(model, inputs, hidden):
+    """
+    The previous forward pass of RNN/GRU, which writes the logits of every
+    time-step into a preallocated tensor. Kept here as the baseline.
+    """
+    logits = torch.zeros([model.seq_len, model.batch_size, model.vocab_size], device=inputs.device)
+    embedded_inp = model.embedding_layer(inputs)
+    for t in range(model.seq_len):
+        inp_x = embedded_inp[t]
+        hidden_next = []
+        for layer_no in range(model.num_layers):
+            inp_x = model.recurrent_layers[layer_no](inp_x, hidden[layer_no])
+            hidden_next.append(inp_x)
+        hidden = torch.stack(hidden_next)
+        logits[t] = model.output_layer(inp_x)
+    return logits, hidden
+
+
+def time_train_step(forward, model, num_iters):
+    """
+    Returns the number of tokens per second for forward + backward of
+    the cross-entropy loss.
+    """
+    loss_fn = nn.CrossEntropyLoss()
+    inputs = torch.randint(model.vocab_size, (model.seq_len, model.batch_size), device=device)
+    targets = torch.randint(model.vocab_size, (model.seq_len * model.batch_size,), device=device)
+    hidden = model.init_hidden().to(device)
+
+    # warm-up
+    for i in range(num_iters + 1):
+        if i == 1:
+            sync()
+            start_time = time.time()
+        model.zero_grad()
+        logits, _ = forward(model, inputs, hidden)
+        loss = loss_fn(logits.view(-1, model.vocab_size), targets)
+        loss.backward()
+    sync()
+    return num_iters * model.seq_len * model.batch_size / (time.time() - start_time)
+
+
+def bench_output(args):
+    print('model\temb\thidden\tseq_len\tbatch\tlayers\tper-step (wps)\tbatched (wps)\tspeedup')
+    for model_type, emb_size, hidden_size, seq_len, batch_size, num_layers in CONFIGS:
+        model_class = RNN if model_type == 'RNN' else GRU
+        model = model_class(emb_size=emb_size, hidden_size=hidden_size,
+                            seq_len=seq_len, batch_size=batch_size,
+                            vocab_size=args.vocab_size, num_layers=num_layers,
+                            dp_keep_prob=0.35).to(device)
+        model.train()
+        per_step = time_train_step(per_step_output_forward, model, args.num_iters)
+        batched = time_train_step(lambda m, x, h: m(x, h), model, args.num_iters)
+        print('\t'.join(str(v) for v in [model_type, emb_size, hidden_size, seq_len, batch_size, num_layers])
+              + '\t%.0f\t%.0f\t%.2fx' % (per_step, batched, batched / per_step))
+
+
+def separate_qkv_attention_forward(attn, x, mask):
+    """
+    Self-attention with three separate query, key and value projections, as
+    MultiHeadedAttention did before they were fused. Kept here as the baseline.
+    """
+    batch_size = x.size(0)
+    W_q, W_k, W_v = attn.QKV_ll.weight.chunk(3, dim=0)
+    b_q, b_k, b_v = attn.QKV_ll.bias.chunk(3, dim=0)
+    query = F.linear(x, W_q, b_q).view(batch_size, -1, attn.n_heads, attn.d_k).transpose(1, 2)
+    key = F.linear(x, W_k, b_k).view(batch_size, -1, attn.n_heads, attn.d_k).transpose(1, 2)
+    value = F.linear(x, W_v, b_v).view(batch_size, -1, attn.n_heads, attn.d_k).transpose(1, 2)
+    s = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(attn.d_k)
+    s = F.softmax(s + mask.unsqueeze(1), dim=-1)
+    s = torch.matmul(attn.dropout(s), value)
+    s = s.transpose(1, 2).contiguous().view(batch_size, -1, attn.n_units)
+    return attn.Out_ll(s)
+
+
+def time_attention(forward, attn, x, mask, num_iters):
+    "Returns the number of tokens per second for forward + backward of the attention."
+    for i in range(num_iters + 1):
+        if i == 1:
+            sync()
+            start_time = time.time()
+        attn.zero_grad()
+        forward(attn, x, mask).sum().backward()
+    sync()
+    return num_iters * x.size(0) * x.size(1) / (time.time() - start_time)
+
+
+def bench_attention(args):
+    # the TRANSFORMER settings of Problem 4.1: batch_size=128, seq_len=35, hidden_size=512, 16 heads
+    print('batch\tseq_len\tn_units\theads\tseparate (wps)\tfused (wps)\tspeedup')
+    for batch_size, seq_len, n_units, n_heads in [(128, 35, 512, 16), (20, 35, 512, 16)]:
+        attn = MultiHeadedAttention(n_heads, n_units, dropout=0.1).to(device)
+        x = torch.randn(batch_size, seq_len, n_units, device=device, requires_grad=True)
+        mask = causal_mask_bias(seq_len, device)
+        separate = time_attention(separate_qkv_attention_forward, attn, x, mask, args.num_iters)
+        fused = time_attention(lambda a, x, m: a(x, x, x, m), attn, x, mask, args.num_iters)
+        print('\t'.join(str(v) for v in [batch_size, seq_len, n_units, n_heads])
+              + '\t%.0f\t%.0f\t%.2fx' % (separate, fused, fused / separate))
+
+
+def saved_bytes(fn, params=()):
+    """
+    Runs fn() and returns its result, with the number of bytes of the
+    tensors autograd saved for the backward pass. Every storage is counted
+    once, and the storages of params (the model parameters) are not counted.
+    """
+    total = [0]
+    seen = set(p.data_ptr() for p in params)
+
+    def pack(t):
+        ptr = t.untyped_storage().data_ptr()
+        if ptr not in seen:
+            seen.add(ptr)
+            total[0] += t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, total[0]
+
+
+def bench_blockwise(args):
+    """
+    Checks blockwise_attention against the dense softmax attention (outputs and
+    gradients, causal mask, no dropout) and compares their time and the memory
+    saved for backward at growing sequence lengths.
+    """
+    batch_size, n_heads, d_k, block_size = 20, 16, 32, 64
+    print('seq_len\tmax |out diff|\tmax |grad diff|\tdense (ms)\tblockwise (ms)\tdense saved (MB)\tblockwise saved (MB)')
+    for seq_len in [35, 256, 1024]:
+        q, k, v = [torch.randn(batch_size, n_heads, seq_len, d_k, device=device, requires_grad=True)
+                   for _ in range(3)]
+        mask = causal_mask_bias(seq_len, device)
+        grad = torch.randn(batch_size, n_heads, seq_len, d_k, device=device)
+
+        def dense():
+            s = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(d_k)
+            return torch.matmul(F.softmax(s + mask.unsqueeze(1), dim=-1), v)
+
+        results = []
+        for fn in [dense, lambda: blockwise_attention(q, k, v, causal=True, block_size=block_size)]:
+            sync()
+            start_time = time.time()
+            out, saved = saved_bytes(fn)
+            grads = torch.autograd.grad(out, [q, k, v], grad)
+            sync()
+            results.append((out, grads, 1000 * (time.time() - start_time), saved / 2 ** 20))
+        (out_d, grads_d, t_d, m_d), (out_b, grads_b, t_b, m_b) = results
+        out_diff = (out_d - out_b).abs().max().item()
+        grad_diff = max((g_d - g_b).abs().max().item() for g_d, g_b in zip(grads_d, grads_b))
+        print('%d\t%.2e\t%.2e\t%.1f\t%.1f\t%.1f\t%.1f' % (seq_len, out_diff, grad_diff, t_d, t_b, m_d, m_b))
+
+
+def bench_checkpoint(args):
+    """
+    Compares a training step with and without activation checkpointing:
+    the memory autograd keeps for the backward pass against the step time.
+    """
+    seq_len = 35
+    print('model\tsetting\tsaved (MB)\tstep (ms)')
+    configs = [('RNN', 'hidden_size=1500, batch_size=20', 0, 5),
+               ('GRU', 'hidden_size=1500, batch_size=20', 0, 5),
+               ('TRANSFORMER', 'hidden_size=512, 6 blocks, batch_size=128', False, True)]
+    for model_type, setting, off, on in configs:
+        results = []
+        for value in [off, on]:
+            torch.manual_seed(args.seed)
+            if model_type == 'TRANSFORMER':
+                batch_size = 128
+                model = make_model(args.vocab_size, n_blocks=6, n_units=512, dropout=0.1,
+                                   checkpoint_blocks=value).to(device)
+                inputs = torch.randint(args.vocab_size, (batch_size, seq_len), device=device)
+                mask = Batch.make_mask(inputs, -1)
+                forward = lambda: model(inputs, mask)
+            else:
+                batch_size = 20
+                model_class = RNN if model_type == 'RNN' else GRU
+                model = model_class(emb_size=200, hidden_size=1500, seq_len=seq_len, batch_size=batch_size,
+                                    vocab_size=args.vocab_size, num_layers=2, dp_keep_prob=0.35,
+                                    checkpoint_steps=value).to(device)
+                inputs = torch.randint(args.vocab_size, (seq_len, batch_size), device=device)
+                hidden = model.init_hidden().to(device)
+                forward = lambda: model.forward_hidden(inputs, hidden)[0]
+            model.train()
+            elapsed = []
+            for i in range(args.num_iters + 1):
+                model.zero_grad()
+                sync()
+                start_time = time.time()
+                out, saved = saved_bytes(forward, list(model.parameters()))
+                out.sum().backward()
+                sync()
+                elapsed.append(time.time() - start_time)
+            # skip the warm-up iteration
+            results.append((saved / 2 ** 20, 1000 * sum(elapsed[1:]) / args.num_iters))
+        for (saved, step), name in zip(results, ['off', 'on']):
+            print('%s\t%s, checkpointing %s\t%.1f\t%.1f' % (model_type, setting, name, saved, step))
+        print('%s\tmemory saved: %.0f%%, extra compute: %.0f%%' % (
+            model_type, 100 * (1 - results[1][0] / results[0][0]), 100 * (results[1][1] / results[0][1] - 1)))
+
+
+def loop_sgd_step(params, lr, max_norm):
+    """
+    The previous SGD update of ptb-lm.py: clip_grad_norm_, then one add_ per
+    parameter. Kept here as the baseline.
+    """
+    params = list(params)
+    torch.nn.utils.clip_grad_norm_(params, max_norm)
+    for p in params:
+        if p.grad is not None:
+            p.data.add_(p.grad.data, alpha=-lr)
+
+
+def bench_sgd(args):
+    """
+    Times the optimizer step alone (gradient clipping and SGD update) for the
+    1500-hidden GRU of Problem 4.1, on random gradients.
+    """
+    model = GRU(emb_size=200, hidden_size=1500, seq_len=35, batch_size=20,
+                vocab_size=args.vocab_size, num_layers=2, dp_keep_prob=0.35).to(device)
+    params = list(model.parameters())
+    for p in params:
+        p.grad = torch.randn_like(p)
+    print('model\tparams\ttensors\tloop (ms)\tfused (ms)\tspeedup')
+    results = []
+    for step in [loop_sgd_step, clipped_sgd_step]:
+        for i in range(args.num_iters + 1):
+            if i == 1:
+                # skip the warm-up iteration
+                sync()
+                start_time = time.time()
+            step(params, 1e-6, 0.25)
+        sync()
+        results.append(1000 * (time.time() - start_time) / args.num_iters)
+    print('GRU\t%d\t%d\t%.2f\t%.2f\t%.2fx' % (sum(p.numel() for p in params), len(params),
+                                              results[0], results[1], results[0] / results[1]))
+
+
+BENCHMARKS = {
+    'output': bench_output,
+    'attention': bench_attention,
+    'blockwise': bench_blockwise,
+    'checkpoint': bench_checkpoint,
+    'sgd': bench_sgd,
+}
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    if args.bench not in BENCHMARKS:
+        print("Benchmark not recognized, choose one of: " + ', '.join(sorted(BENCHMARKS)))
+    else:
+        BENCHMARKS[args.bench](args)
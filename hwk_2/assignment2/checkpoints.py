@@ -0,0 +1,102 @@
+# Training-state snapshots for the Penn Treebank language modeling script
+# (ptb-lm.py), so that an interrupted experiment can be resumed.
+#
+# Saving a snapshot only copies the state to the CPU on the training thread;
+# a background thread serializes it. Files are written to a temporary name
+# and renamed, so a crash never leaves a partial snapshot behind, and only the
+# keep most recent snapshots are kept.
+
+import glob
+import os
+import queue
+import threading
+import torch
+
+SNAPSHOT_PATTERN = 'snapshot_*.pt'
+
+
+def cpu_copy(state):
+    """
+    A copy of state (nested dicts, lists and tuples of tensors and other
+    values) with every tensor copied to the CPU, so that training can go on
+    modifying the original tensors while the copy is written.
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, cpu_copy(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_copy(v) for v in state)
+    return state
+
+
+def snapshot_path(directory, epoch):
+    return os.path.join(directory, 'snapshot_%04d.pt' % epoch)
+
+
+def latest_snapshot(directory):
+    "The path of the most recent snapshot in directory, or None if there is none."
+    paths = sorted(glob.glob(os.path.join(directory, SNAPSHOT_PATTERN)))
+    return paths[-1] if paths else None
+
+
+def atomic_save(obj, path):
+    "torch.save to a temporary file next to path, then renamed to path."
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints from a background thread.
+
+    save(state, path) copies state to the CPU and returns; save_snapshot also
+    removes the oldest snapshots of directory once the new one is written.
+    Errors of the background thread are raised by the next call to save,
+    save_snapshot or close. close() waits for the pending writes.
+    """
+    def __init__(self, directory, keep=2):
+        if keep < 1:
+            raise ValueError("keep must be at least 1, got %r" % keep)
+        self.directory = directory
+        self.keep = keep
+        self.error = None
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            state, path, rotate = item
+            try:
+                atomic_save(state, path)
+                if rotate:
+                    self._rotate()
+            except Exception as e:
+                self.error = e
+
+    def _rotate(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, SNAPSHOT_PATTERN)))
+        for path in paths[:max(len(paths) - self.keep, 0)]:
+            os.remove(path)
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, path, rotate=False):
+        self._check()
+        self.pending.put((cpu_copy(state), path, rotate))
+
+    def save_snapshot(self, state, epoch):
+        self.save(state, snapshot_path(self.directory, epoch), rotate=True)
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        self._check()
@@ -7,8 +7,8 @@ import math
 import copy
 import time
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 import matplotlib.pyplot as plt
-from torch.distributions.categorical import Categorical
 
 # NOTE ==============================================
 #
@@ -45,9 +45,77 @@ def clones(module, N):
     """
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
 
+
+def layer_major_forward(recurrent_layers, embedded_inp, hidden, return_states=False):
+    """
+    Runs a stack of recurrent layers one layer at a time instead of one time-step
+    at a time. Layer l only depends on the outputs of layer l-1, so its input
+    projection is computed for the whole sequence with a single matmul over
+    (seq_len * batch_size, input_size), and only the recurrence is left inside
+    the time loop. The result is the same as the time-step major loop.
+
+    Each layer must provide project_input(x) and recur(x_proj, h).
+
+    inputs:
+        recurrent_layers: the stack of layers, input layer first
+        embedded_inp: shape (seq_len, batch_size, emb_size)
+        hidden: shape (num_layers, batch_size, hidden_size)
+
+    returns:
+        the outputs of the last layer, shape (seq_len, batch_size, hidden_size)
+        the final hidden states, shape (num_layers, batch_size, hidden_size)
+        if return_states, also the hidden states after every time-step,
+            shape (seq_len, num_layers, batch_size, hidden_size)
+    """
+    seq_len, batch_size = embedded_inp.size(0), embedded_inp.size(1)
+    layer_inp = embedded_inp
+    hidden_next = []
+    states = []
+    for layer_no, layer in enumerate(recurrent_layers):
+        # all time-steps in one matmul, then back to (seq_len, batch_size, -1)
+        x_proj = layer.project_input(layer_inp.reshape(seq_len * batch_size, -1))
+        x_proj = x_proj.view(seq_len, batch_size, -1)
+        h = hidden[layer_no]
+        layer_out = []
+        for t in range(seq_len):
+            h = layer.recur(x_proj[t], h)
+            layer_out.append(h)
+        layer_inp = torch.stack(layer_out)
+        hidden_next.append(h)
+        states.append(layer_inp)
+
+    if return_states:
+        return layer_inp, torch.stack(hidden_next), torch.stack(states, dim=1)
+    return layer_inp, torch.stack(hidden_next)
+
 # Problem 1
 
 
+def checkpointed_forward(run_steps, embedded_inp, hidden, checkpoint_steps):
+    """
+    Runs a recurrent stack over segments of checkpoint_steps time-steps with
+    activation checkpointing: only the hidden states between segments are kept
+    for the backward pass, and each segment is recomputed when its gradients
+    are needed.
+
+    inputs:
+        run_steps: a function (embedded_inp, hidden) -> (top_out, hidden)
+        embedded_inp: shape (seq_len, batch_size, emb_size)
+        hidden: shape (num_layers, batch_size, hidden_size)
+        checkpoint_steps (int): the number of time-steps per segment
+
+    returns:
+        the outputs of the last layer, shape (seq_len, batch_size, hidden_size)
+        the final hidden states, shape (num_layers, batch_size, hidden_size)
+    """
+    top_out = []
+    for t in range(0, embedded_inp.size(0), checkpoint_steps):
+        segment_out, hidden = checkpoint(run_steps, embedded_inp[t:t + checkpoint_steps], hidden,
+                                         use_reentrant=False)
+        top_out.append(segment_out)
+    return torch.cat(top_out), hidden
+
+
 class RNN_Hidden_Layer(nn.Module):
     def __init__(self, input_size, hidden_size, p=0, act='tanh'):
         super(RNN_Hidden_Layer, self).__init__()
@@ -74,14 +142,20 @@ class RNN_Hidden_Layer(nn.Module):
         # This is for b_h
         nn.init.uniform_(self.linear_h.bias, a=-np.sqrt(1 / self.hidden_size), b=np.sqrt(1 / self.hidden_size))
 
-    def forward(self, x, h):
+    def project_input(self, x):
         # for the dropout layer after the embedding layer
         x = self.dropout(x)
-        x = self.linear_x(x)
+        return self.linear_x(x)
+
+    def recur(self, x_proj, h):
+        # x_proj is the output of project_input, so only W_h is applied here
         h = self.linear_h(h)
-        out = self.activation(x + h)
+        out = self.activation(x_proj + h)
         return out
 
+    def forward(self, x, h):
+        return self.recur(self.project_input(x), h)
+
 
 class Linear_Layer(nn.Module):
     def __init__(self, hidden_size, vocab_size, p):
@@ -101,19 +175,372 @@ class Linear_Layer(nn.Module):
         out = self.fc(x)
         return out
 
+    def chunked_loss(self, x, targets, chunk_size=1024):
+        """
+        The mean cross-entropy of self.forward(x) against targets, computed
+        chunk_size rows at a time so that the (N, vocab_size) logits are never
+        materialized. See chunked_cross_entropy.
+        """
+        x = self.dropout(x)
+        return chunked_cross_entropy(x, self.fc.weight, self.fc.bias, targets, chunk_size)
+
+
+class Adaptive_Output_Layer(nn.Module):
+    """
+    Drop-in replacement for Linear_Layer using an adaptive softmax
+    (Grave et al., 2017, https://arxiv.org/abs/1609.04309).
+
+    Token ids must be sorted by decreasing frequency, as done by _build_vocab
+    in ptb-lm.py. The ids below cutoffs[0] form the head cluster, which is a
+    full hidden_size x (cutoffs[0] + n_clusters) projection; the rarer ids are
+    split into tail clusters with smaller projections, which are only evaluated
+    for the tokens that fall in them when training.
+    """
+    def __init__(self, hidden_size, vocab_size, p, cutoffs=(2000, 6000), div_value=4.0):
+        super(Adaptive_Output_Layer, self).__init__()
+        self.fc = nn.AdaptiveLogSoftmaxWithLoss(hidden_size, vocab_size, list(cutoffs), div_value=div_value)
+        self.dropout = nn.Dropout(p=p)
+
+    def forward(self, x):
+        # exact log-probabilities over the whole vocabulary, for evaluation and sampling.
+        # These can be used as logits: applying a (log-)softmax to them is the identity.
+        x = self.dropout(x)
+        out = self.fc.log_prob(x.reshape(-1, x.size(-1)))
+        return out.view(x.shape[:-1] + (-1,))
+
+    def loss(self, x, targets):
+        # the mean negative log-likelihood of targets, only computing the tail
+        # clusters that contain a target. Used for training.
+        x = self.dropout(x)
+        return self.fc(x.reshape(-1, x.size(-1)), targets.reshape(-1)).loss
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Mean cross-entropy of the logits x W^T + b against targets, computed over
+    chunks of rows. The forward pass only keeps the log-sum-exp of each row;
+    the backward pass recomputes the logits of one chunk at a time, so at most
+    (chunk_size, vocab_size) logits exist at any point.
+    """
+    @staticmethod
+    def forward(ctx, x, weight, bias, targets, chunk_size):
+        n = x.size(0)
+        lse = x.new_empty(n)
+        loss = x.new_zeros(())
+        for i in range(0, n, chunk_size):
+            logits = torch.addmm(bias, x[i:i + chunk_size], weight.t())
+            lse[i:i + chunk_size] = torch.logsumexp(logits, dim=1)
+            target_logits = logits.gather(1, targets[i:i + chunk_size].unsqueeze(1)).squeeze(1)
+            loss += (lse[i:i + chunk_size] - target_logits).sum()
+        ctx.save_for_backward(x, weight, bias, targets, lse)
+        ctx.chunk_size = chunk_size
+        return loss / n
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        x, weight, bias, targets, lse = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        n = x.size(0)
+        grad_x = torch.empty_like(x)
+        grad_weight = torch.zeros_like(weight)
+        grad_bias = torch.zeros_like(bias)
+        scale = grad_loss / n
+        for i in range(0, n, chunk_size):
+            x_chunk = x[i:i + chunk_size]
+            # d loss / d logits = softmax(logits) - onehot(targets)
+            grad_logits = torch.addmm(bias, x_chunk, weight.t())
+            grad_logits.sub_(lse[i:i + chunk_size].unsqueeze(1)).exp_()
+            grad_logits.scatter_add_(1, targets[i:i + chunk_size].unsqueeze(1),
+                                     grad_logits.new_full((x_chunk.size(0), 1), -1.))
+            grad_logits.mul_(scale)
+            grad_x[i:i + chunk_size] = grad_logits.mm(weight)
+            grad_weight.addmm_(grad_logits.t(), x_chunk)
+            grad_bias += grad_logits.sum(0)
+        return grad_x, grad_weight, grad_bias, None, None
+
+
+def chunked_cross_entropy(x, weight, bias, targets, chunk_size=1024):
+    """
+    Memory-bounded equivalent of nn.CrossEntropyLoss()(F.linear(x, weight, bias), targets).
+
+    inputs:
+        x: the final hidden states, shape (..., hidden_size)
+        weight, bias: the parameters of the output projection, shapes
+            (vocab_size, hidden_size) and (vocab_size)
+        targets: the target token ids, shape (...)
+        chunk_size (int): the number of rows whose logits are computed at once
+
+    returns:
+        the mean cross-entropy as a scalar tensor
+
+    Small vocabularies (e.g. character-level) take a fast path: when there are
+    no more logits than hidden units, the full logits are no larger than x, so
+    they are computed at once by F.cross_entropy instead of chunk by chunk.
+    """
+    x = x.reshape(-1, x.size(-1))
+    targets = targets.reshape(-1)
+    if weight.size(0) <= weight.size(1):
+        return F.cross_entropy(F.linear(x, weight, bias), targets)
+    return ChunkedCrossEntropy.apply(x, weight, bias, targets, chunk_size)
+
+
+def sample_logits(logits, temperature=1.0, top_k=0, top_p=1.0):
+    """
+    Samples one token per row of logits, with the Gumbel-max trick: the argmax
+    of logits / temperature plus Gumbel noise is a sample of their softmax, so
+    no probabilities or distribution objects are built.
+
+    inputs:
+        logits: shape (batch_size, vocab_size), unnormalized log-probabilities
+        temperature (float): > 1 flattens the distribution, < 1 sharpens it
+        top_k (int): if > 0, only sample from the top_k most likely tokens
+        top_p (float): if < 1, nucleus sampling: only sample from the smallest
+            set of most likely tokens whose probabilities sum to at least top_p
+
+    returns:
+        the sampled token ids, shape (batch_size)
+    """
+    logits = logits / temperature
+    if top_k > 0 and top_k < logits.size(-1):
+        kth = logits.topk(top_k, dim=-1)[0][:, -1:]
+        logits = logits.masked_fill(logits < kth, float('-inf'))
+    if top_p < 1.0:
+        sorted_logits, order = logits.sort(dim=-1, descending=True)
+        sorted_probs = F.softmax(sorted_logits, dim=-1)
+        # drop a token if the more likely ones already reach top_p (the most
+        # likely token is always kept), then back to the vocabulary order
+        drop = (sorted_probs.cumsum(-1) - sorted_probs) >= top_p
+        # also with top_p <= 0
+        drop[..., 0] = False
+        drop = torch.zeros_like(drop).scatter(-1, order, drop)
+        logits = logits.masked_fill(drop, float('-inf'))
+    gumbel = -torch.empty_like(logits).exponential_().log()
+    return (logits + gumbel).argmax(dim=-1)
+
+
+def recurrent_generate(model, input, hidden, generated_seq_len, **sampling):
+    """
+    The generate method of RNN and GRU: runs model one time-step at a time,
+    under inference mode, sampling each next token with sample_logits and
+    writing it into a preallocated (generated_seq_len + 1, batch_size) tensor,
+    whose first row is input.
+    """
+    with torch.inference_mode():
+        gen_samples = input.new_empty((generated_seq_len + 1, input.numel()))
+        gen_samples[0] = input.view(-1)
+        for t in range(generated_seq_len):
+            # embedded_inp shape is (1, batch_size, emb_size)
+            embedded_inp = model.embedding_layer(gen_samples[t:t + 1])
+            top_out, hidden = model.run_steps(embedded_inp, hidden)
+            # (batch_size, vocab_size)
+            logits = model.output_layer(top_out[0])
+            gen_samples[t + 1] = sample_logits(logits, **sampling)
+    return gen_samples
+
+
+def recurrent_beam_search(model, input, hidden, max_len, beam_size=5, eos_id=None, length_penalty=1.0):
+    """
+    The beam_search method of RNN and GRU: batched beam search, under inference
+    mode. The batch_size * beam_size hypotheses share one hidden state tensor,
+    which is reordered with a single index_select per step; each step only
+    records the chosen tokens and their parent hypotheses, and the best
+    sequences are traced back at the end.
+
+    Hypotheses are ranked by their log-likelihood divided by their length **
+    length_penalty (0 ranks by log-likelihood alone). A hypothesis that emits
+    eos_id is finished: it is then only extended with eos_id, at no cost, and
+    the search stops early once all hypotheses are finished.
+
+    inputs:
+        model: a RNN or GRU
+        input: the first tokens, shape (batch_size)
+        hidden: the initial hidden states, shape (num_layers, batch_size, hidden_size)
+        max_len (int): the maximum number of tokens to generate
+        beam_size (int): the number of hypotheses kept per batch element
+        eos_id (int): the id of <eos>, or None to always generate max_len tokens
+        length_penalty (float): the exponent of the length normalization
+
+    returns:
+        the best sequence of each batch element, after the input tokens (and
+        padded with eos_id once finished), shape (generated_len + 1, batch_size)
+        their normalized scores, shape (batch_size)
+    """
+    with torch.inference_mode():
+        batch_size = input.numel()
+        n_hyps = batch_size * beam_size
+        device = input.device
+        tokens = input.new_empty((max_len + 1, n_hyps))
+        parents = torch.empty((max_len + 1, n_hyps), dtype=torch.long, device=device)
+        tokens[0] = input.view(-1).repeat_interleave(beam_size)
+        hidden = hidden.repeat_interleave(beam_size, dim=1)
+        # only the first hypothesis of each batch element is expanded at the first step
+        scores = torch.full((batch_size, beam_size), float('-inf'), device=device)
+        scores[:, 0] = 0.
+        lengths = torch.zeros((batch_size, beam_size), device=device)
+        finished = torch.zeros((batch_size, beam_size), dtype=torch.bool, device=device)
+        # index of the first hypothesis of each batch element, shape (batch_size, 1)
+        first = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+
+        steps = max_len
+        for t in range(max_len):
+            embedded_inp = model.embedding_layer(tokens[t:t + 1])
+            top_out, hidden = model.run_steps(embedded_inp, hidden)
+            log_probs = F.log_softmax(model.output_layer(top_out[0]), dim=-1)
+            log_probs = log_probs.view(batch_size, beam_size, -1)
+            vocab_size = log_probs.size(-1)
+            if eos_id is not None:
+                log_probs = log_probs.masked_fill(finished.unsqueeze(-1), float('-inf'))
+                log_probs[..., eos_id] = log_probs[..., eos_id].masked_fill(finished, 0.)
+
+            # (batch_size, beam_size, vocab_size) candidates, ranked by normalized score
+            candidates = scores.unsqueeze(-1) + log_probs
+            candidate_lengths = (lengths + (~finished).float()).unsqueeze(-1)
+            normalized = candidates / candidate_lengths ** length_penalty
+            best = normalized.view(batch_size, -1).topk(beam_size, dim=-1)[1]
+            beam = torch.div(best, vocab_size, rounding_mode='floor')
+            token = best % vocab_size
+
+            scores = candidates.view(batch_size, -1).gather(1, best)
+            lengths = candidate_lengths.squeeze(-1).gather(1, beam)
+            finished = finished.gather(1, beam)
+            if eos_id is not None:
+                finished = finished | (token == eos_id)
+            parent = (first + beam).view(-1)
+            tokens[t + 1] = token.view(-1)
+            parents[t + 1] = parent
+            hidden = hidden.index_select(1, parent)
+            if eos_id is not None and bool(finished.all()):
+                steps = t + 1
+                break
+
+        best_scores, best = (scores / lengths.clamp(min=1) ** length_penalty).max(dim=1)
+        hyp = first.squeeze(1) + best
+        best_seqs = tokens.new_empty((steps + 1, batch_size))
+        for t in range(steps, 0, -1):
+            best_seqs[t] = tokens[t, hyp]
+            hyp = parents[t, hyp]
+        best_seqs[0] = tokens[0, hyp]
+    return best_seqs, best_scores
+
+
+def speculative_generate(draft, target, input, draft_hidden, target_hidden, generated_seq_len, k=4,
+                         return_hidden=False):
+    """
+    Speculative sampling (Leviathan et al., 2023, https://arxiv.org/abs/2211.17192;
+    Chen et al., 2023, https://arxiv.org/abs/2302.01318) from target, a large
+    RNN or GRU, with draft, a small RNN or GRU over the same vocabulary.
+
+    Each round, draft samples k tokens one at a time, and target scores all of
+    them in one layer-major pass (see layer_major_forward). Draft token i is
+    accepted with probability min(1, p_i / q_i), where p and q are the
+    probabilities of target and draft; the first rejected one is replaced by a
+    sample of max(0, p - q) (normalized), and if all are accepted a (k+1)-th
+    token is sampled from target. The samples are thus distributed exactly as
+    those of target.generate. Every row of the batch keeps the same number of
+    tokens per round: the smallest number of leading accepted tokens, plus one
+    (which, for the rows that accepted more, is their accepted draft token).
+
+    Arguments:
+        - draft, target: the models, in eval mode
+        - input: the first tokens, shape (batch_size)
+        - draft_hidden, target_hidden: their initial hidden states
+        - generated_seq_len: the number of tokens to generate
+        - k: the number of draft tokens per round
+        - return_hidden: whether to also return the hidden states
+    Returns:
+        - the sampled sequences after the input tokens, as RNN.generate
+                shape: (generated_seq_len + 1, batch_size)
+        - the fraction of the draft tokens that were accepted
+        - if return_hidden, the hidden states of target and draft after all
+          the returned tokens but the last, from which generation can go on
+    """
+    with torch.inference_mode():
+        batch_size = input.numel()
+        # room for the last round, which can go past generated_seq_len
+        gen_samples = input.new_empty((generated_seq_len + k + 2, batch_size))
+        gen_samples[0] = input.view(-1)
+        length = 0
+        proposed = accepted = 0
+        while length < generated_seq_len:
+            last = gen_samples[length]
+
+            # draft: k tokens, and the hidden states after each of its k + 1 inputs
+            draft_tokens, draft_probs, draft_states = [], [], []
+            inp = last
+            for i in range(k + 1):
+                top_out, draft_hidden = draft.run_steps(draft.embedding_layer(inp.view(1, -1)), draft_hidden)
+                draft_states.append(draft_hidden)
+                if i == k:
+                    break
+                probs = F.softmax(draft.output_layer(top_out[0]), dim=-1)
+                inp = torch.multinomial(probs, 1).view(-1)
+                draft_tokens.append(inp)
+                draft_probs.append(probs)
+            draft_tokens = torch.stack(draft_tokens)  # (k, batch_size)
+            draft_probs = torch.stack(draft_probs)  # (k, batch_size, vocab_size)
+
+            # target: the probabilities after last and each draft token, in one pass
+            inputs = torch.cat([last.view(1, -1), draft_tokens])
+            top_out, _, target_states = layer_major_forward(
+                target.recurrent_layers, target.embedding_layer(inputs), target_hidden, return_states=True)
+            target_probs = F.softmax(target.output_layer(top_out), dim=-1)  # (k + 1, batch_size, vocab_size)
+
+            # leading accepted draft tokens of each row
+            p = target_probs[:k].gather(2, draft_tokens.unsqueeze(-1)).squeeze(-1)
+            q = draft_probs.gather(2, draft_tokens.unsqueeze(-1)).squeeze(-1)
+            accept = torch.rand_like(q) * q < p
+            n_accepted = accept.long().cumprod(0).sum(0)
+            m = int(n_accepted.min())
+            proposed += k * batch_size
+            accepted += int(n_accepted.sum())
+
+            gen_samples[length + 1:length + m + 1] = draft_tokens[:m]
+            if m == k:
+                next_token = torch.multinomial(target_probs[k], 1).view(-1)
+            else:
+                residual = (target_probs[m] - draft_probs[m]).clamp(min=0)
+                # p == q leaves no residual, but then the draft token is always accepted
+                residual = torch.where(residual.sum(-1, keepdim=True) > 0, residual, target_probs[m])
+                next_token = torch.multinomial(residual, 1).view(-1)
+                next_token = torch.where(n_accepted > m, draft_tokens[m], next_token)
+            gen_samples[length + m + 1] = next_token
+
+            # both models go back to their state after last and the m kept draft
+            # tokens, or fewer in the last round, whose tokens past
+            # generated_seq_len are not returned
+            kept = min(m, generated_seq_len - length - 1)
+            target_hidden = target_states[kept]
+            draft_hidden = draft_states[kept]
+            length += m + 1
+    if return_hidden:
+        return gen_samples[:generated_seq_len + 1], accepted / max(proposed, 1), target_hidden, draft_hidden
+    return gen_samples[:generated_seq_len + 1], accepted / max(proposed, 1)
+
 
 class RNN(nn.Module):  # Implement a stacked vanilla RNN with Tanh nonlinearities.
-    def __init__(self, emb_size, hidden_size, seq_len, batch_size, vocab_size, num_layers, dp_keep_prob):
+    def __init__(self, emb_size, hidden_size, seq_len, batch_size, vocab_size, num_layers, dp_keep_prob,
+                 layer_major=False, adaptive_cutoffs=None, checkpoint_steps=0):
         """
         emb_size:     The number of units in the input embeddings
         hidden_size:  The number of hidden units per layer
-        seq_len:      The length of the input sequences
+        seq_len:      The default length of the input sequences
+        batch_size:   The default batch size, used by init_hidden when it is
+                      not given one. The forward pass takes its shapes from
+                      its inputs, so any seq_len and batch_size can be used.
         vocab_size:   The number of tokens in the vocabulary (10,000 for Penn TreeBank)
         num_layers:   The depth of the stack (i.e. the number of hidden layers at 
                       each time-step)
         dp_keep_prob: The probability of *not* dropping out units in the 
                       non-recurrent connections.
                       Do not apply dropout on recurrent connections.
+        layer_major:  If True, forward runs one layer at a time over the whole
+                      sequence, so the input projection of each layer is a
+                      single matmul over all time-steps.
+        adaptive_cutoffs: If given, the output layer is an Adaptive_Output_Layer
+                      with these cluster cutoffs instead of a Linear_Layer.
+        checkpoint_steps: If > 0, when training, only the hidden states at every
+                      checkpoint_steps time-steps are kept for the backward
+                      pass, and the activations in between are recomputed.
         """
         super(RNN, self).__init__()
 
@@ -137,6 +564,8 @@ class RNN(nn.Module):  # Implement a stacked vanilla RNN with Tanh nonlinearitie
         self.batch_size = batch_size
         self.vocab_size = vocab_size
         self.num_layers = num_layers
+        self.layer_major = layer_major
+        self.checkpoint_steps = checkpoint_steps
         self.embedding_layer = nn.Embedding(num_embeddings=vocab_size, embedding_dim=emb_size)
 
         # self.drop_p is the dropout probability, hence it is equal to 1 - dp_keep_prob
@@ -145,7 +574,11 @@ class RNN(nn.Module):  # Implement a stacked vanilla RNN with Tanh nonlinearitie
 
         self.input_layer = RNN_Hidden_Layer(emb_size, hidden_size, self.drop_p)
         self.rnn_layer = RNN_Hidden_Layer(hidden_size, hidden_size, self.drop_p)
-        self.output_layer = Linear_Layer(self.hidden_size, self.vocab_size, self.drop_p)
+        if adaptive_cutoffs is None:
+            self.output_layer = Linear_Layer(self.hidden_size, self.vocab_size, self.drop_p)
+        else:
+            self.output_layer = Adaptive_Output_Layer(self.hidden_size, self.vocab_size, self.drop_p,
+                                                      cutoffs=adaptive_cutoffs)
 
         self.recurrent_layers = clones(self.rnn_layer, self.num_layers - 1)
         self.recurrent_layers.insert(0, self.input_layer)
@@ -157,12 +590,13 @@ class RNN(nn.Module):  # Implement a stacked vanilla RNN with Tanh nonlinearitie
         # and output biases to 0 (in place). The embeddings should not use a bias vector.
         nn.init.uniform_(self.embedding_layer.weight, a=-0.1, b=0.1)
 
-    def init_hidden(self):
+    def init_hidden(self, batch_size=None):
         # initialize the hidden states to zero
         """
         This is used for the first mini-batch in an epoch, only.
+        batch_size defaults to self.batch_size.
         """
-        h = torch.zeros([self.num_layers, self.batch_size, self.hidden_size])
+        h = torch.zeros([self.num_layers, batch_size or self.batch_size, self.hidden_size])
         if torch.cuda.is_available():
             h = h.cuda()
 
@@ -203,10 +637,47 @@ class RNN(nn.Module):  # Implement a stacked vanilla RNN with Tanh nonlinearitie
                   if you are curious.
                         shape: (num_layers, batch_size, hidden_size)
         """
-        logits = torch.zeros([self.seq_len, self.batch_size, self.vocab_size], device=inputs.device)
+        top_out, hidden = self.forward_hidden(inputs, hidden)
+
+        # logits for all time steps in a single matmul over (seq_len * batch_size, hidden_size)
+        seq_len, batch_size = inputs.size(0), inputs.size(1)
+        logits = self.output_layer(top_out.view(seq_len * batch_size, self.hidden_size))
+
+        # returns logits of shape (seq_len, batch_size, vocab_size),
+        # hidden of shape (num_layers, batch_size, hidden_size)
+        return logits.view(seq_len, batch_size, self.vocab_size), hidden
+
+    def forward_hidden(self, inputs, hidden):
+        """
+        The forward pass without the output layer, see forward for the arguments.
+        Returns the outputs of the last hidden layer, shape (seq_len, batch_size, hidden_size),
+        and the final hidden states, shape (num_layers, batch_size, hidden_size).
+        These can be given to output_layer.chunked_loss (or output_layer.loss for an
+        Adaptive_Output_Layer) instead of computing the logits.
+        """
+        # shape (seq_len, batch_size, emb_size), with the shapes of inputs
         embedded_inp = self.embedding_layer(inputs)
-        embedded_inp = embedded_inp.view(self.seq_len, self.batch_size, self.emb_size)
-        for t in range(self.seq_len):
+        if self.checkpoint_steps and self.training and torch.is_grad_enabled():
+            # only keep the activations at every checkpoint_steps time-steps,
+            # the others are recomputed during the backward pass
+            top_out, hidden = checkpointed_forward(self.run_steps, embedded_inp, hidden, self.checkpoint_steps)
+        else:
+            top_out, hidden = self.run_steps(embedded_inp, hidden)
+
+        # returns the last layer outputs of shape (seq_len, batch_size, hidden_size),
+        # hidden of shape (num_layers, batch_size, hidden_size)
+        return top_out, hidden
+
+    def run_steps(self, embedded_inp, hidden):
+        """
+        Runs the stack over the embedded inputs, of shape (n_steps, batch_size, emb_size).
+        Returns the outputs of the last hidden layer and the final hidden states.
+        """
+        if self.layer_major:
+            return layer_major_forward(self.recurrent_layers, embedded_inp, hidden)
+
+        top_out = []
+        for t in range(embedded_inp.size(0)):
             # x[t] shape is [batch_size, embedding_size]
             inp_x = embedded_inp[t]
             hidden_next = []
@@ -218,15 +689,11 @@ class RNN(nn.Module):  # Implement a stacked vanilla RNN with Tanh nonlinearitie
                 hidden_next.append(cur_t_out)
 
             hidden = torch.stack(hidden_next)
-            # logits at the current time step are computed based on the output of the last layer of stacked RNN
-            # logits[t] shape is [batch_size, vocab_size]
-            logits[t] = self.output_layer(inp_x)
-
-        # returns logits of shape (seq_len, batch_size, vocab_size),
-        # hidden of shape (num_layers, batch_size, hidden_size)
-        return logits.view(self.seq_len, self.batch_size, self.vocab_size), hidden
+            # the output of the last layer of stacked RNN, the logits are computed from it
+            top_out.append(inp_x)
+        return torch.stack(top_out), hidden
 
-    def generate(self, input, hidden, generated_seq_len):
+    def generate(self, input, hidden, generated_seq_len, **sampling):
         # Compute the forward pass, as in the self.forward method (above).
         # You'll probably want to copy substantial portions of that code here.
         #
@@ -245,39 +712,32 @@ class RNN(nn.Module):  # Implement a stacked vanilla RNN with Tanh nonlinearitie
             - generated_seq_len: The length of the sequence to generate.
                            Note that this can be different than the length used 
                            for training (self.seq_len)
+            - sampling: temperature, top_k and top_p, see sample_logits
         Returns:
-            - Sampled sequences of tokens
-                        shape: (generated_seq_len, batch_size)
+            - Sampled sequences of tokens, after the input tokens
+                        shape: (generated_seq_len + 1, batch_size)
         """
-        gen_samples = input.view(1, -1)
-        # embedded_inp shape is (1, batch_size, emb_size)
-        embedded_inp = self.embedding_layer(gen_samples)
+        return recurrent_generate(self, input, hidden, generated_seq_len, **sampling)
 
-        for t in range(generated_seq_len):
-            inp_x = embedded_inp[0]
-            hidden_next = []
-            for layer_no in range(self.num_layers):
-                cur_t_out = self.recurrent_layers[layer_no](inp_x, hidden[layer_no])
-                # This is the input for next layer
-                inp_x = cur_t_out
-                # next hidden state
-                hidden_next.append(cur_t_out)
-
-            hidden = torch.stack(hidden_next)
-            logits = self.output_layer(inp_x).detach()
-            # (batch_size, vocab_size)
-            softmax_probs = F.softmax(logits, dim=1)
-            out_idx = Categorical(probs=softmax_probs).sample()
-            # out_idx : (1, batch_size)
-            out_idx = out_idx.view(1, -1)
-
-            gen_samples = torch.cat((gen_samples, out_idx), dim=0)
-            embedded_inp = self.embedding_layer(out_idx)
-
-        return gen_samples
+    def beam_search(self, input, hidden, max_len, beam_size=5, eos_id=None, length_penalty=1.0):
+        """
+        Deterministic decoding of the most likely continuations of input,
+        see recurrent_beam_search for the arguments.
+        """
+        return recurrent_beam_search(self, input, hidden, max_len, beam_size, eos_id, length_penalty)
 
 
 class GRUCell(nn.Module):
+    """
+    GRU cell with fused gate computations.
+
+    The input weights of the reset, forget and cell gates are stored as a single
+    [W_r|W_z|W_c] matrix and the recurrent weights of the reset and forget gates
+    as a single [U_r|U_z] matrix, so a step costs two matmuls (one for [U_r|U_z] h
+    and one for U_c (r * h)) once the input projection has been computed.
+    Checkpoints saved with the previous layout (one RNN_Hidden_Layer per gate)
+    are converted when they are loaded.
+    """
     def __init__(self, input_size, hidden_size, p):
         super(GRUCell, self).__init__()
 
@@ -285,20 +745,55 @@ class GRUCell(nn.Module):
         self.hidden_size = hidden_size
         self.drop_p = p
 
-        self.reset_gate = RNN_Hidden_Layer(self.input_size, self.hidden_size, p=self.drop_p, act='sigmoid')
-        self.forget_gate = RNN_Hidden_Layer(self.input_size, self.hidden_size, p=self.drop_p, act='sigmoid')
-        self.cell_state = RNN_Hidden_Layer(self.input_size, self.hidden_size, p=self.drop_p, act='tanh')
+        # [W_r|W_z|W_c], no bias as in RNN_Hidden_Layer
+        self.linear_x = nn.Linear(self.input_size, 3 * self.hidden_size, bias=False)
+        # [U_r|U_z] with [b_r|b_z]
+        self.linear_h_rz = nn.Linear(self.hidden_size, 2 * self.hidden_size)
+        # U_c with b_c, applied to r * h
+        self.linear_h_c = nn.Linear(self.hidden_size, self.hidden_size)
+        self.dropout = nn.Dropout(p=self.drop_p)
+        self.init_weights()
 
-    def forward(self, x, h):
+    def init_weights(self):
+        k = np.sqrt(1 / self.hidden_size)
+        for param in self.parameters():
+            nn.init.uniform_(param, a=-k, b=k)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert the old per-gate layout (reset_gate, forget_gate, cell_state)
+        gates = ['reset_gate', 'forget_gate', 'cell_state']
+        if prefix + 'reset_gate.linear_x.weight' in state_dict:
+            old = {}
+            for gate in gates:
+                for name in ['linear_x.weight', 'linear_h.weight', 'linear_h.bias']:
+                    old[gate + '.' + name] = state_dict.pop(prefix + gate + '.' + name)
+            state_dict[prefix + 'linear_x.weight'] = torch.cat(
+                [old[gate + '.linear_x.weight'] for gate in gates], dim=0)
+            state_dict[prefix + 'linear_h_rz.weight'] = torch.cat(
+                [old[gate + '.linear_h.weight'] for gate in gates[:2]], dim=0)
+            state_dict[prefix + 'linear_h_rz.bias'] = torch.cat(
+                [old[gate + '.linear_h.bias'] for gate in gates[:2]], dim=0)
+            state_dict[prefix + 'linear_h_c.weight'] = old['cell_state.linear_h.weight']
+            state_dict[prefix + 'linear_h_c.bias'] = old['cell_state.linear_h.bias']
+        super(GRUCell, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_input(self, x):
+        # (..., 3 * hidden_size): the W_r x, W_z x and W_c x terms side by side
+        x = self.dropout(x)
+        return self.linear_x(x)
 
-        r = self.reset_gate(x, h)
-        z = self.forget_gate(x, h)
-        c = self.cell_state(x, r * h)
+    def recur(self, x_proj, h):
+        x_rz, x_c = x_proj[..., :2 * self.hidden_size], x_proj[..., 2 * self.hidden_size:]
+        r, z = torch.sigmoid(x_rz + self.linear_h_rz(h)).chunk(2, dim=-1)
+        c = torch.tanh(x_c + self.linear_h_c(r * h))
 
         out = (1 - z) * h + z * c
 
         return out
 
+    def forward(self, x, h):
+        return self.recur(self.project_input(x), h)
+
 
 class GRU(nn.Module):  # Implement a stacked GRU RNN
     """
@@ -306,7 +801,8 @@ class GRU(nn.Module):  # Implement a stacked GRU RNN
     GRU, not Vanilla RNN.
     """
 
-    def __init__(self, emb_size, hidden_size, seq_len, batch_size, vocab_size, num_layers, dp_keep_prob):
+    def __init__(self, emb_size, hidden_size, seq_len, batch_size, vocab_size, num_layers, dp_keep_prob,
+                 layer_major=False, adaptive_cutoffs=None, checkpoint_steps=0):
         super(GRU, self).__init__()
 
         # TODO ========================
@@ -316,6 +812,8 @@ class GRU(nn.Module):  # Implement a stacked GRU RNN
         self.batch_size = batch_size
         self.vocab_size = vocab_size
         self.num_layers = num_layers
+        self.layer_major = layer_major
+        self.checkpoint_steps = checkpoint_steps
         self.embedding_layer = nn.Embedding(num_embeddings=vocab_size, embedding_dim=emb_size)
 
         # self.drop_p is the dropout probability, hence it is equal to 1 - dp_keep_prob
@@ -324,7 +822,11 @@ class GRU(nn.Module):  # Implement a stacked GRU RNN
 
         self.input_layer = GRUCell(emb_size, hidden_size, self.drop_p)
         self.gru_layer = GRUCell(hidden_size, hidden_size, self.drop_p)
-        self.output_layer = Linear_Layer(self.hidden_size, self.vocab_size, self.drop_p)
+        if adaptive_cutoffs is None:
+            self.output_layer = Linear_Layer(self.hidden_size, self.vocab_size, self.drop_p)
+        else:
+            self.output_layer = Adaptive_Output_Layer(self.hidden_size, self.vocab_size, self.drop_p,
+                                                      cutoffs=adaptive_cutoffs)
 
         self.recurrent_layers = clones(self.gru_layer, self.num_layers - 1)
         self.recurrent_layers.insert(0, self.input_layer)
@@ -335,10 +837,10 @@ class GRU(nn.Module):  # Implement a stacked GRU RNN
         # TODO ========================
         nn.init.uniform_(self.embedding_layer.weight, a=-0.1, b=0.1)
 
-    def init_hidden(self):
+    def init_hidden(self, batch_size=None):
         # TODO ========================
-
-        h = torch.zeros([self.num_layers, self.batch_size, self.hidden_size])
+        # batch_size defaults to self.batch_size
+        h = torch.zeros([self.num_layers, batch_size or self.batch_size, self.hidden_size])
         if torch.cuda.is_available():
             h = h.cuda()
 
@@ -347,36 +849,49 @@ class GRU(nn.Module):  # Implement a stacked GRU RNN
 
     def forward(self, inputs, hidden):
         # TODO ========================
-        logits = torch.zeros([self.seq_len, self.batch_size, self.vocab_size], device=inputs.device)
-        embedded_inp = self.embedding_layer(inputs)
-        embedded_inp = embedded_inp.view(self.seq_len, self.batch_size, self.emb_size)
-        for t in range(self.seq_len):
-            # x[t] shape is [batch_size, embedding_size]
-            inp_x = embedded_inp[t]
-            hidden_next = []
-            for layer_no in range(self.num_layers):
-                cur_t_out = self.recurrent_layers[layer_no](inp_x, hidden[layer_no])
-                # This is the input for next layer
-                inp_x = cur_t_out
-                # next hidden state
-                hidden_next.append(cur_t_out)
+        top_out, hidden = self.forward_hidden(inputs, hidden)
 
-            hidden = torch.stack(hidden_next)
-            # logits at the current time step are computed based on the output of the last layer of stacked RNN
-            # logits[t] shape is [batch_size, vocab_size]
-            logits[t] = self.output_layer(inp_x)
+        # logits for all time steps in a single matmul over (seq_len * batch_size, hidden_size)
+        seq_len, batch_size = inputs.size(0), inputs.size(1)
+        logits = self.output_layer(top_out.view(seq_len * batch_size, self.hidden_size))
 
         # returns logits of shape (seq_len, batch_size, vocab_size),
         # hidden of shape (num_layers, batch_size, hidden_size)
-        return logits.view(self.seq_len, self.batch_size, self.vocab_size), hidden
+        return logits.view(seq_len, batch_size, self.vocab_size), hidden
 
-    def generate(self, input, hidden, generated_seq_len):
-        gen_samples = input.view(1, -1)
-        # embedded_inp shape is (1, batch_size, emb_size)
-        embedded_inp = self.embedding_layer(gen_samples)
+    def forward_hidden(self, inputs, hidden):
+        """
+        The forward pass without the output layer, see forward for the arguments.
+        Returns the outputs of the last hidden layer, shape (seq_len, batch_size, hidden_size),
+        and the final hidden states, shape (num_layers, batch_size, hidden_size).
+        These can be given to output_layer.chunked_loss (or output_layer.loss for an
+        Adaptive_Output_Layer) instead of computing the logits.
+        """
+        # shape (seq_len, batch_size, emb_size), with the shapes of inputs
+        embedded_inp = self.embedding_layer(inputs)
+        if self.checkpoint_steps and self.training and torch.is_grad_enabled():
+            # only keep the activations at every checkpoint_steps time-steps,
+            # the others are recomputed during the backward pass
+            top_out, hidden = checkpointed_forward(self.run_steps, embedded_inp, hidden, self.checkpoint_steps)
+        else:
+            top_out, hidden = self.run_steps(embedded_inp, hidden)
+
+        # returns the last layer outputs of shape (seq_len, batch_size, hidden_size),
+        # hidden of shape (num_layers, batch_size, hidden_size)
+        return top_out, hidden
 
-        for t in range(generated_seq_len):
-            inp_x = embedded_inp[0]
+    def run_steps(self, embedded_inp, hidden):
+        """
+        Runs the stack over the embedded inputs, of shape (n_steps, batch_size, emb_size).
+        Returns the outputs of the last hidden layer and the final hidden states.
+        """
+        if self.layer_major:
+            return layer_major_forward(self.recurrent_layers, embedded_inp, hidden)
+
+        top_out = []
+        for t in range(embedded_inp.size(0)):
+            # x[t] shape is [batch_size, embedding_size]
+            inp_x = embedded_inp[t]
             hidden_next = []
             for layer_no in range(self.num_layers):
                 cur_t_out = self.recurrent_layers[layer_no](inp_x, hidden[layer_no])
@@ -386,17 +901,19 @@ class GRU(nn.Module):  # Implement a stacked GRU RNN
                 hidden_next.append(cur_t_out)
 
             hidden = torch.stack(hidden_next)
-            logits = self.output_layer(inp_x).detach()
-            # (batch_size, vocab_size)
-            softmax_probs = F.softmax(logits, dim=1)
-            out_idx = Categorical(probs=softmax_probs).sample()
-            # out_idx : (1, batch_size)
-            out_idx = out_idx.view(1, -1)
+            # the output of the last layer of stacked RNN, the logits are computed from it
+            top_out.append(inp_x)
+        return torch.stack(top_out), hidden
 
-            gen_samples = torch.cat((gen_samples, out_idx), dim=0)
-            embedded_inp = self.embedding_layer(out_idx)
+    def generate(self, input, hidden, generated_seq_len, **sampling):
+        return recurrent_generate(self, input, hidden, generated_seq_len, **sampling)
 
-        return gen_samples
+    def beam_search(self, input, hidden, max_len, beam_size=5, eos_id=None, length_penalty=1.0):
+        """
+        Deterministic decoding of the most likely continuations of input,
+        see recurrent_beam_search for the arguments.
+        """
+        return recurrent_beam_search(self, input, hidden, max_len, beam_size, eos_id, length_penalty)
 
 
 # Problem 3
@@ -461,11 +978,14 @@ and a linear layer followed by a softmax.
 
 # TODO: implement this class
 class MultiHeadedAttention(nn.Module):
-    def __init__(self, n_heads, n_units, dropout=0.1):
+    def __init__(self, n_heads, n_units, dropout=0.1, block_size=None):
         """
         n_heads: the number of attention heads
         n_units: the number of output units
         dropout: probability of DROPPING units
+        block_size: if given, attention is computed in (block_size x block_size)
+                    tiles with an online softmax (see blockwise_attention), so the
+                    (seq_len x seq_len) attention matrix is never stored
         """
         super(MultiHeadedAttention, self).__init__()
         # This sets the size of the keys, values, and queries (self.d_k) to all
@@ -484,36 +1004,99 @@ class MultiHeadedAttention(nn.Module):
 
         self.n_heads = n_heads
         self.dropout = nn.Dropout(p=dropout)
+        self.block_size = block_size
 
-        self.Q_ll, self.K_ll, self.V_ll, self.Out_ll = clones(nn.Linear(n_units, n_units), 4)
+        # The query, key and value projections are stored as a single
+        # [W_q|W_k|W_v] projection, so self-attention computes all three
+        # with one matmul.
+        self.QKV_ll = nn.Linear(n_units, 3 * n_units)
+        self.Out_ll = nn.Linear(n_units, n_units)
 
-        nn.init.uniform_(self.Q_ll.weight, a=-k, b=k)
-        nn.init.uniform_(self.Q_ll.bias, a=-k, b=k)
-
-        nn.init.uniform_(self.K_ll.weight, a=-k, b=k)
-        nn.init.uniform_(self.K_ll.bias, a=-k, b=k)
-
-        nn.init.uniform_(self.V_ll.weight, a=-k, b=k)
-        nn.init.uniform_(self.V_ll.bias, a=-k, b=k)
+        nn.init.uniform_(self.QKV_ll.weight, a=-k, b=k)
+        nn.init.uniform_(self.QKV_ll.bias, a=-k, b=k)
 
         nn.init.uniform_(self.Out_ll.weight, a=-k, b=k)
         nn.init.uniform_(self.Out_ll.bias, a=-k, b=k)
 
-        
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert the old layout with separate Q_ll, K_ll and V_ll
+        if prefix + 'Q_ll.weight' in state_dict:
+            for name in ['weight', 'bias']:
+                state_dict[prefix + 'QKV_ll.' + name] = torch.cat(
+                    [state_dict.pop(prefix + ll + '.' + name) for ll in ['Q_ll', 'K_ll', 'V_ll']], dim=0)
+        super(MultiHeadedAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-    def forward(self, query, key, value, mask=None):
+    def project_qkv(self, query, key, value):
+        """
+        Applies the query, key and value projections and splits the heads.
+        Returns query, key and value of size (batch_size, n_heads, seq_len, d_k).
+        """
+        batch_size = query.size(0)
+        if query is key and key is value:
+            # self-attention: one matmul and one reshape for all three
+            qkv = self.QKV_ll(query).view(batch_size, -1, 3, self.n_heads, self.d_k)
+            qkv = qkv.permute(2, 0, 3, 1, 4)  # 3 * batch_size * n_heads * seq_length * d_k
+            return qkv[0], qkv[1], qkv[2]
+
+        W_q, W_k, W_v = self.QKV_ll.weight.chunk(3, dim=0)
+        b_q, b_k, b_v = self.QKV_ll.bias.chunk(3, dim=0)
+        query = F.linear(query, W_q, b_q).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
+        key   = F.linear(key, W_k, b_k).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
+        value = F.linear(value, W_v, b_v).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
+        return query, key, value
+
+    def init_cache(self, batch_size, max_len, device=None):
+        """
+        Preallocates the key/value cache used by forward for incremental decoding.
+
+        returns:
+            a dict with the keys and values of the positions seen so far, each of
+            shape (batch_size, n_heads, max_len, d_k), and their number ('length')
+        """
+        shape = (batch_size, self.n_heads, max_len, self.d_k)
+        return {'key': torch.zeros(shape, device=device),
+                'value': torch.zeros(shape, device=device),
+                'length': 0}
+
+    def forward(self, query, key, value, mask=None, cache=None):
         # TODO: implement the masked multi-head attention.
         # query, key, and value all have size: (batch_size, seq_len, self.n_units)
         # mask has size: (batch_size, seq_len, seq_len)
         # As described in the .tex, apply input masking to the softmax
         # generating the "attention values" (i.e. A_i in the .tex)
         # Also apply dropout to the attention values.
+        #
+        # If a cache (see init_cache) is given, the keys and values of the new
+        # positions are appended to it, and the queries attend to all the cached
+        # positions. The mask, if any, must then be of size
+        # (batch_size, seq_len, cache length + seq_len).
+        #
+        # The mask is either boolean (True where attending is allowed) or an
+        # additive bias as returned by Batch.make_mask (see mask_to_bias).
 
         batch_size = query.size(0)
 
-        query = self.Q_ll(query).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)  # batch_size * n_heads * seq_length * d_k
-        key   = self.K_ll(key).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)  # batch_size * n_heads * seq_length * d_k
-        value = self.V_ll(value).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)  # batch_size * n_heads * seq_length * d_k
+        query, key, value = self.project_qkv(query, key, value)  # batch_size * n_heads * seq_length * d_k
+
+        if cache is not None:
+            start, end = cache['length'], cache['length'] + key.size(2)
+            cache['key'][:, :, start:end] = key
+            cache['value'][:, :, start:end] = value
+            cache['length'] = end
+            key = cache['key'][:, :, :end]  # batch_size * n_heads * cache length * d_k
+            value = cache['value'][:, :, :end]
+
+        if self.block_size:
+            causal = False
+            if mask is not None and mask.dtype.is_floating_point and query.size(2) == key.size(2):
+                # the cached causal bias is recomputed per tile instead of being read
+                causal = is_causal_mask_bias(mask)
+            s = blockwise_attention(query, key, value,
+                                    None if mask is None or causal else mask_to_bias(mask, query.dtype),
+                                    causal=causal, block_size=self.block_size,
+                                    dropout=self.dropout.p if self.training else 0.)
+            s = s.transpose(1, 2).contiguous().view(batch_size, -1, self.n_heads * self.d_k)
+            return self.Out_ll(s)
 
         # perform attention
         d_k = query.size(-1)
@@ -521,8 +1104,8 @@ class MultiHeadedAttention(nn.Module):
         s = torch.matmul(query, key_t) / math.sqrt(d_k) # batch_size * n_heads * seq_length * seq_length
 
         if mask is not None:
-            mask = mask.unsqueeze(1).float() # (batch_size, 1, seq_len, seq_len)
-            s = s * mask - 1e9 * (1 - mask)
+            # masked positions get a large negative bias, added in place
+            s += mask_to_bias(mask, s.dtype).unsqueeze(1) # (batch_size, 1, seq_len, seq_len)
 
         s = F.softmax(s, dim=-1)  # batch_size * n_heads * seq_length * seq_length
 
@@ -536,6 +1119,127 @@ class MultiHeadedAttention(nn.Module):
 
 
 
+class BlockwiseAttention(torch.autograd.Function):
+    """
+    softmax(q k^T / sqrt(d_k) + bias) v, computed over (block_size x block_size)
+    tiles of the attention matrix with an online softmax: for each block of
+    queries, a running max and a running sum of the exponentials are kept while
+    going through the blocks of keys. The forward pass only stores the output and
+    the log-sum-exp of each query; the backward pass recomputes the attention
+    weights one tile at a time.
+
+    Attention dropout is applied to the normalized weights, as in
+    MultiHeadedAttention. The dropout mask of a tile is drawn from a generator
+    seeded with (seed + tile index), so the backward pass can redraw it.
+    """
+    @staticmethod
+    def _tile_scores(q, k, bias, causal, i, j, fill):
+        s = torch.matmul(q, k.transpose(-2, -1))
+        if bias is not None:
+            s += bias[..., i:i + q.size(2), j:j + k.size(2)].unsqueeze(1)
+        if causal:
+            rows = torch.arange(i, i + q.size(2), device=q.device).unsqueeze(1)
+            cols = torch.arange(j, j + k.size(2), device=q.device).unsqueeze(0)
+            s.masked_fill_(cols > rows, fill)
+        return s
+
+    @staticmethod
+    def _tile_dropout(p, dropout, seed, tile):
+        generator = torch.Generator(device=p.device)
+        generator.manual_seed(seed + tile)
+        keep = torch.rand(p.shape, generator=generator, device=p.device) >= dropout
+        return keep.to(p.dtype) / (1 - dropout)
+
+    @staticmethod
+    def forward(ctx, q, k, v, bias, causal, block_size, dropout):
+        scale = 1 / math.sqrt(q.size(-1))
+        q = q * scale
+        fill = _mask_fill_value(q.dtype)
+        seed = int(torch.randint(2 ** 31, (1,)).item()) if dropout > 0 else 0
+        n_q, n_k = q.size(2), k.size(2)
+        n_k_blocks = (n_k + block_size - 1) // block_size
+        out = torch.empty_like(q)
+        lse = q.new_empty(q.shape[:-1])
+        for i in range(0, n_q, block_size):
+            q_i = q[:, :, i:i + block_size]
+            m_i = q_i.new_full(q_i.shape[:-1] + (1,), -float('inf'))
+            l_i = q_i.new_zeros(q_i.shape[:-1] + (1,))
+            acc_i = torch.zeros_like(q_i)
+            for j in range(0, n_k, block_size):
+                if causal and j > i + q_i.size(2) - 1:
+                    break  # this tile and the next ones are entirely in the future
+                s = BlockwiseAttention._tile_scores(q_i, k[:, :, j:j + block_size], bias, causal, i, j, fill)
+                m_new = torch.max(m_i, s.max(dim=-1, keepdim=True)[0])
+                p = torch.exp(s - m_new)
+                correction = torch.exp(m_i - m_new)
+                l_i = l_i * correction + p.sum(dim=-1, keepdim=True)
+                if dropout > 0:
+                    p = p * BlockwiseAttention._tile_dropout(
+                        p, dropout, seed, (i // block_size) * n_k_blocks + j // block_size)
+                acc_i = acc_i * correction + torch.matmul(p, v[:, :, j:j + block_size])
+                m_i = m_new
+            out[:, :, i:i + block_size] = acc_i / l_i
+            lse[:, :, i:i + block_size] = (m_i + torch.log(l_i)).squeeze(-1)
+
+        ctx.save_for_backward(q, k, v, bias, out, lse)
+        ctx.settings = (causal, block_size, dropout, seed, scale)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        q, k, v, bias, out, lse = ctx.saved_tensors
+        causal, block_size, dropout, seed, scale = ctx.settings
+        fill = _mask_fill_value(q.dtype)
+        n_q, n_k = q.size(2), k.size(2)
+        n_k_blocks = (n_k + block_size - 1) // block_size
+        grad_q = torch.zeros_like(q)
+        grad_k = torch.zeros_like(k)
+        grad_v = torch.zeros_like(v)
+        # sum_j P_ij dP_ij, which is also (dO * O) summed over d_k
+        delta = (grad_out * out).sum(dim=-1, keepdim=True)
+        for i in range(0, n_q, block_size):
+            q_i = q[:, :, i:i + block_size]
+            grad_out_i = grad_out[:, :, i:i + block_size]
+            for j in range(0, n_k, block_size):
+                if causal and j > i + q_i.size(2) - 1:
+                    break
+                k_j, v_j = k[:, :, j:j + block_size], v[:, :, j:j + block_size]
+                s = BlockwiseAttention._tile_scores(q_i, k_j, bias, causal, i, j, fill)
+                p = torch.exp(s - lse[:, :, i:i + block_size].unsqueeze(-1))
+                grad_p = torch.matmul(grad_out_i, v_j.transpose(-2, -1))
+                if dropout > 0:
+                    keep = BlockwiseAttention._tile_dropout(
+                        p, dropout, seed, (i // block_size) * n_k_blocks + j // block_size)
+                    grad_v[:, :, j:j + block_size] += torch.matmul((p * keep).transpose(-2, -1), grad_out_i)
+                    grad_p = grad_p * keep
+                else:
+                    grad_v[:, :, j:j + block_size] += torch.matmul(p.transpose(-2, -1), grad_out_i)
+                grad_s = p * (grad_p - delta[:, :, i:i + block_size])
+                grad_q[:, :, i:i + block_size] += torch.matmul(grad_s, k_j)
+                grad_k[:, :, j:j + block_size] += torch.matmul(grad_s.transpose(-2, -1), q_i)
+        # q was scaled before the scores were computed
+        return grad_q * scale, grad_k, grad_v, None, None, None, None
+
+
+def blockwise_attention(query, key, value, bias=None, causal=False, block_size=64, dropout=0.):
+    """
+    Memory-efficient attention, see BlockwiseAttention.
+
+    inputs:
+        query, key, value: size (batch_size, n_heads, seq_len, d_k), as in
+            MultiHeadedAttention.forward after the heads are split
+        bias: an additive mask (see mask_to_bias) of size (batch_size or 1,
+            query seq_len, key seq_len), or None
+        causal (bool): hide future positions, without reading a mask
+        block_size (int): the size of the tiles of the attention matrix
+        dropout (float): the probability of dropping an attention weight
+
+    returns:
+        the attention output, size (batch_size, n_heads, seq_len, d_k)
+    """
+    return BlockwiseAttention.apply(query, key, value, bias, causal, block_size, dropout)
+
+
 #----------------------------------------------------------------------------------
 # The encodings of elements of the input sequence
 
@@ -565,8 +1269,9 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        x = x + Variable(self.pe[:, :x.size(1)],
+    def forward(self, x, offset=0):
+        # offset is the position of x[:, 0], when decoding one step at a time
+        x = x + Variable(self.pe[:, offset:offset + x.size(1)],
                          requires_grad=False)
         return self.dropout(x)
 
@@ -583,8 +1288,8 @@ class TransformerBlock(nn.Module):
         self.feed_forward = feed_forward
         self.sublayer = clones(ResidualSkipConnectionWithLayerNorm(size, dropout), 2)
 
-    def forward(self, x, mask):
-        x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask))  # apply the self-attention
+    def forward(self, x, mask, cache=None):
+        x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask, cache))  # apply the self-attention
         return self.sublayer[1](x, self.feed_forward)  # apply the position-wise MLP
 
 
@@ -593,14 +1298,22 @@ class TransformerStack(nn.Module):
     This will be called on the TransformerBlock (above) to create a stack.
     """
 
-    def __init__(self, layer, n_blocks):  # layer will be TransformerBlock (below)
+    def __init__(self, layer, n_blocks, checkpoint_blocks=False):  # layer will be TransformerBlock (below)
         super(TransformerStack, self).__init__()
         self.layers = clones(layer, n_blocks)
         self.norm = LayerNorm(layer.size)
-
-    def forward(self, x, mask):
-        for layer in self.layers:
-            x = layer(x, mask)
+        # if True, the activations inside each block are recomputed during backward
+        self.checkpoint_blocks = checkpoint_blocks
+
+    def forward(self, x, mask, caches=None):
+        # caches: one key/value cache per block, for incremental decoding
+        if self.checkpoint_blocks and caches is None and self.training and torch.is_grad_enabled():
+            for layer in self.layers:
+                x = checkpoint(layer, x, mask, use_reentrant=False)
+            return self.norm(x)
+
+        for i, layer in enumerate(self.layers):
+            x = layer(x, mask, None if caches is None else caches[i])
         return self.norm(x)
 
 
@@ -612,27 +1325,91 @@ class FullTransformer(nn.Module):
         self.output_layer = nn.Linear(n_units, vocab_size)
 
     def forward(self, input_sequence, mask):
+        return F.log_softmax(self.output_layer(self.forward_hidden(input_sequence, mask)), dim=-1)
+
+    def forward_hidden(self, input_sequence, mask):
+        "The output of the transformer stack, before the output layer and the softmax."
         embeddings = self.embedding(input_sequence)
-        return F.log_softmax(self.output_layer(self.transformer_stack(embeddings, mask)), dim=-1)
+        return self.transformer_stack(embeddings, mask)
+
+    def generate(self, input, generated_seq_len, **sampling):
+        """
+        Samples continuations of a batch of prompts, one token at a time.
+
+        Every block keeps a cache of the keys and values of the positions seen
+        so far, so each new token only runs the stack on one position and
+        attends to the cache, instead of re-running the whole prefix.
+
+        Arguments:
+            - input: A mini-batch of prompts (or of single tokens)
+                            shape: (batch_size, prompt_len) or (batch_size)
+            - generated_seq_len: The number of tokens to sample after the prompts
+            - sampling: temperature, top_k and top_p, see sample_logits
+        Returns:
+            - The prompts followed by the sampled tokens, in the same layout as
+              RNN.generate
+                        shape: (prompt_len + generated_seq_len, batch_size)
+        """
+        word_embedding, position = self.embedding[0], self.embedding[1]
+        prompt = input.view(input.size(0), -1)
+        batch_size, prompt_len = prompt.size()
+        total_len = prompt_len + generated_seq_len
+        caches = [layer.self_attn.init_cache(batch_size, total_len, device=prompt.device)
+                  for layer in self.transformer_stack.layers]
+
+        gen_samples = torch.zeros([total_len, batch_size], dtype=torch.long, device=prompt.device)
+        gen_samples[:prompt_len] = prompt.t()
+
+        # run the whole prompt at once to fill the caches
+        mask = causal_mask_bias(prompt_len, prompt.device)
+        inp = prompt
+        offset = 0
+        with torch.inference_mode():
+            for t in range(prompt_len, total_len):
+                x = position(word_embedding(inp), offset)
+                x = self.transformer_stack(x, mask, caches)
+                offset += inp.size(1)
+                # (batch_size, vocab_size), for the last position only
+                logits = self.output_layer(x[:, -1])
+                out_idx = sample_logits(logits, **sampling)
+                gen_samples[t] = out_idx
+                # afterwards, a single position attends to all the cached ones
+                inp = out_idx.view(-1, 1)
+                mask = None
+
+        return gen_samples
+
+
+def transformer_sizes(state_dict):
+    "n_units and n_blocks of a saved make_model transformer, read from its parameters."
+    n_units = state_dict['output_layer.weight'].size(1)
+    blocks = set(name.split('.')[2] for name in state_dict if name.startswith('transformer_stack.layers.'))
+    return n_units, len(blocks)
 
 
 def make_model(vocab_size, n_blocks=6,
-               n_units=512, n_heads=16, dropout=0.1):
+               n_units=512, n_heads=16, dropout=0.1, attention_block_size=None,
+               checkpoint_blocks=False):
     "Helper: Construct a model from hyperparameters."
     c = copy.deepcopy
-    attn = MultiHeadedAttention(n_heads, n_units)
+    attn = MultiHeadedAttention(n_heads, n_units, block_size=attention_block_size)
     ff = MLP(n_units, dropout)
     position = PositionalEncoding(n_units, dropout)
     model = FullTransformer(
-        transformer_stack=TransformerStack(TransformerBlock(n_units, c(attn), c(ff), dropout), n_blocks),
+        transformer_stack=TransformerStack(TransformerBlock(n_units, c(attn), c(ff), dropout), n_blocks,
+                                           checkpoint_blocks=checkpoint_blocks),
         embedding=nn.Sequential(WordEmbedding(n_units, vocab_size), c(position)),
         n_units=n_units,
         vocab_size=vocab_size
     )
 
     # Initialize parameters with Glorot / fan_avg.
-    for p in model.parameters():
-        if p.dim() > 1:
+    for name, p in model.named_parameters():
+        if name.endswith('QKV_ll.weight'):
+            # [W_q|W_k|W_v] is initialized as three n_units x n_units matrices
+            for w in p.data.chunk(3, dim=0):
+                nn.init.xavier_uniform_(w)
+        elif p.dim() > 1:
             nn.init.xavier_uniform_(p)
     return model
 
@@ -647,6 +1424,59 @@ def subsequent_mask(size):
     return torch.from_numpy(subsequent_mask) == 0
 
 
+# additive causal masks, keyed by (device, dtype): the largest one requested
+# so far, of which the smaller ones are views
+_causal_mask_cache = {}
+
+
+def _mask_fill_value(dtype):
+    # -1e9 does not fit in half precision
+    return max(-1e9, torch.finfo(dtype).min)
+
+
+def causal_mask_bias(size, device=None, dtype=torch.float32):
+    """
+    Additive version of subsequent_mask: a (1, size, size) tensor which is 0 where
+    a position may attend and a large negative value on future positions.
+    Only the largest mask of each (device, dtype) is kept, and smaller sizes
+    are returned as views of it, so the cache does not grow with the number
+    of distinct sizes. The mask must not be modified in place.
+    """
+    device = torch.device(device if device is not None else 'cpu')
+    if device.type == 'cuda' and device.index is None:
+        # same key as the .device of the masks
+        device = torch.device('cuda', torch.cuda.current_device())
+    key = (device, dtype)
+    bias = _causal_mask_cache.get(key)
+    if bias is None or bias.size(-1) < size:
+        bias = torch.full((size, size), _mask_fill_value(dtype), device=device, dtype=dtype)
+        bias = bias.triu_(1).unsqueeze(0)
+        _causal_mask_cache[key] = bias
+    return bias[:, :size, :size]
+
+
+def is_causal_mask_bias(mask):
+    """
+    Whether mask is a view returned by causal_mask_bias (masks returned before
+    the cached one grew are not recognized, and are used as any other bias).
+    """
+    bias = _causal_mask_cache.get((mask.device, mask.dtype))
+    return (bias is not None and mask.dim() == 3 and mask.size(0) == 1
+            and mask.size(1) == mask.size(2) <= bias.size(-1)
+            and mask.data_ptr() == bias.data_ptr() and mask.stride() == bias.stride())
+
+
+def mask_to_bias(mask, dtype=torch.float32):
+    """
+    Converts a boolean mask (True where attending is allowed) to an additive bias.
+    Masks that already are additive biases are only cast to dtype.
+    """
+    if mask.dtype == torch.bool or mask.dtype == torch.uint8:
+        return torch.zeros(mask.shape, device=mask.device, dtype=dtype).masked_fill_(
+            mask == 0, _mask_fill_value(dtype))
+    return mask.to(dtype)
+
+
 class Batch:
     "Object for holding a batch of data with mask during training."
 
@@ -656,11 +1486,16 @@ class Batch:
 
     @staticmethod
     def make_mask(data, pad):
-        "Create a mask to hide future words."
-        mask = (data != pad).unsqueeze(-2)
-        mask = mask & Variable(
-            subsequent_mask(data.size(-1)).type_as(mask.data))
-        return mask
+        """
+        Create a mask to hide future words (and padding), as an additive bias 
+        of shape (batch_size, seq_len, seq_len), or (1, seq_len, seq_len) if 
+        nothing is padding.
+        """
+        bias = causal_mask_bias(data.size(-1), data.device)
+        if pad < 0:
+            # token ids are never negative, so the mask is purely causal
+            return bias
+        return bias.masked_fill((data == pad).unsqueeze(-2), _mask_fill_value(bias.dtype))
 
 
 #----------------------------------------------------------------------------------
@@ -79,14 +79,15 @@
 
 
 import argparse
-import time
 import collections
+import time
 import os
 import sys
 import torch
 import torch.nn
 from torch.autograd import Variable
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy
 np = numpy
 
@@ -94,6 +95,12 @@ np = numpy
 # This is where your models are imported
 from models import RNN, GRU 
 from models import make_model as TRANSFORMER
+from models import chunked_cross_entropy
+import models
+from sgd import clipped_sgd_step, LRSchedule
+from checkpoints import AsyncCheckpointWriter, latest_snapshot
+from ptb_reader import ptb_raw_data, batchify, ptb_tensor_iterator, random_bptt_lengths
+from ptb_reader import batch_remainder
 
 
 ##############################################################################
@@ -107,6 +114,9 @@ parser = argparse.ArgumentParser(description='PyTorch Penn Treebank Language Mod
 # Arguments you may need to set to run different experiments in 4.1 & 4.2.
 parser.add_argument('--data', type=str, default='data',
                     help='location of the data corpus')
+parser.add_argument('--char', action='store_true',
+                    help='character-level language modeling, on the ptb.char.* \
+                    splits of the data corpus. Also reports bits per character')
 parser.add_argument('--model', type=str, default='RNN',
                     help='type of recurrent net (RNN, GRU, TRANSFORMER)')
 parser.add_argument('--optimizer', type=str, default='SGD_LR_SCHEDULE',
@@ -133,6 +143,49 @@ parser.add_argument('--num_epochs', type=int, default=40,
 parser.add_argument('--dp_keep_prob', type=float, default=0.35,
                     help='dropout *keep* probability. drop_prob = 1-dp_keep_prob \
                     (dp_keep_prob=1 means no dropout)')
+parser.add_argument('--loss_chunk_size', type=int, default=0,
+                    help='if > 0, compute the loss from the final hidden states \
+                    this many tokens at a time, without materializing the full \
+                    (seq_len, batch_size, vocab_size) logits. 0 uses the logits, \
+                    unless the vocabulary is no larger than hidden_size (e.g. --char)')
+parser.add_argument('--adaptive_softmax', action='store_true',
+                    help='use an adaptive softmax output layer for the RNN/GRU. \
+                    Training uses its cheaper loss, evaluation the exact log-probabilities')
+parser.add_argument('--adaptive_cutoffs', type=str, default='2000,6000',
+                    help='comma-separated cluster cutoffs of the adaptive softmax. \
+                    Word ids are sorted by frequency, so the first cluster holds \
+                    the most frequent words')
+parser.add_argument('--attention_block_size', type=int, default=0,
+                    help='if > 0, the TRANSFORMER computes attention in tiles of \
+                    this size with an online softmax, without storing the \
+                    (seq_len x seq_len) attention matrix')
+parser.add_argument('--checkpoint', action='store_true',
+                    help='activation checkpointing: recompute activations during \
+                    backward instead of keeping them, for every TRANSFORMER block, \
+                    or every --checkpoint_steps time-steps of the RNN/GRU')
+parser.add_argument('--checkpoint_steps', type=int, default=5,
+                    help='number of time-steps per checkpointed RNN/GRU segment')
+parser.add_argument('--cache_dir', type=str, default='',
+                    help='where to cache the tokenized corpus and vocabulary \
+                    (default: <data>/.cache)')
+parser.add_argument('--no_cache', action='store_true',
+                    help='always re-tokenize the corpus, without reading or \
+                    writing the cache')
+parser.add_argument('--host_data', action='store_true',
+                    help='keep the batched corpus in host memory and copy each \
+                    minibatch to the device, instead of keeping it on the device')
+parser.add_argument('--eval_batch_size', type=int, default=0,
+                    help='batch size of validation/test, which runs without \
+                    autograd. 0 uses batch_size')
+parser.add_argument('--prefetch', type=int, default=0,
+                    help='number of minibatches prepared ahead by a background thread')
+parser.add_argument('--variable_bptt', action='store_true',
+                    help='when training, sample the length of each BPTT window \
+                    around seq_len (seq_len / 2 with probability 0.05), and scale \
+                    the learning rate of each step by its length / seq_len')
+parser.add_argument('--layer_major', action='store_true',
+                    help='run the RNN/GRU one layer at a time over the whole sequence, \
+                    batching the input projections of all time-steps')
 
 # Arguments that you may want to make use of / implement more code for
 parser.add_argument('--debug', action='store_true') 
@@ -141,6 +194,16 @@ parser.add_argument('--save_dir', type=str, default='',
                     This is automatically generated based on the command line \
                     arguments you pass and only needs to be set if you want a \
                     custom dir name')
+parser.add_argument('--snapshot_every', type=int, default=0,
+                    help='save a snapshot of the whole training state (model, \
+                    optimizer, learning rate, random state, learning curves) \
+                    every this many epochs, from a background thread. 0 disables it')
+parser.add_argument('--keep_snapshots', type=int, default=2,
+                    help='number of most recent snapshots kept in the experiment dir')
+parser.add_argument('--resume', type=str, default='',
+                    help='experiment dir to resume from its latest snapshot. \
+                    Pass the same arguments as the interrupted run, with \
+                    --snapshot_every > 0')
 parser.add_argument('--evaluate', action='store_true',
                     help="use this flag to run on the test set. Only do this \
                     ONCE for each model setting, and only after you've \
@@ -164,21 +227,27 @@ experiment_path = os.path.join(args.save_dir+'_'.join([argsdict['model'],
                                          argsdict['optimizer']] 
                                          + flags))
 
-# Increment a counter so that previous results with the same args will not
-# be overwritten. Comment out the next four lines if you only want to keep
-# the most recent results.
-i = 0
-while os.path.exists(experiment_path + "_" + str(i)):
-    i += 1
-experiment_path = experiment_path + "_" + str(i)
-
-# Creates an experimental directory and dumps all the args to a text file
-os.mkdir(experiment_path)
-print ("\nPutting log in %s"%experiment_path)
-argsdict['save_dir'] = experiment_path
-with open (os.path.join(experiment_path,'exp_config.txt'), 'w') as f:
-    for key in sorted(argsdict):
-        f.write(key+'    '+str(argsdict[key])+'\n')
+if args.resume:
+    # keep logging to the experiment dir of the interrupted run
+    experiment_path = args.resume.rstrip(os.sep)
+    print ("\nResuming in %s"%experiment_path)
+    argsdict['save_dir'] = experiment_path
+else:
+    # Increment a counter so that previous results with the same args will not
+    # be overwritten. Comment out the next four lines if you only want to keep
+    # the most recent results.
+    i = 0
+    while os.path.exists(experiment_path + "_" + str(i)):
+        i += 1
+    experiment_path = experiment_path + "_" + str(i)
+
+    # Creates an experimental directory and dumps all the args to a text file
+    os.mkdir(experiment_path)
+    print ("\nPutting log in %s"%experiment_path)
+    argsdict['save_dir'] = experiment_path
+    with open (os.path.join(experiment_path,'exp_config.txt'), 'w') as f:
+        for key in sorted(argsdict):
+            f.write(key+'    '+str(argsdict[key])+'\n')
 
 # Set the random seed manually for reproducibility.
 torch.manual_seed(args.seed)
@@ -199,60 +268,6 @@ else:
 #
 ###############################################################################
 
-# HELPER FUNCTIONS
-def _read_words(filename):
-    with open(filename, "r") as f:
-      return f.read().replace("\n", "<eos>").split()
-
-def _build_vocab(filename):
-    data = _read_words(filename)
-
-    counter = collections.Counter(data)
-    count_pairs = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
-
-    words, _ = list(zip(*count_pairs))
-    word_to_id = dict(zip(words, range(len(words))))
-    id_to_word = dict((v, k) for k, v in word_to_id.items())
-
-    return word_to_id, id_to_word
-
-def _file_to_word_ids(filename, word_to_id):
-    data = _read_words(filename)
-    return [word_to_id[word] for word in data if word in word_to_id]
-
-# Processes the raw data from text files
-def ptb_raw_data(data_path=None, prefix="ptb"):
-    train_path = os.path.join(data_path, prefix + ".train.txt")
-    valid_path = os.path.join(data_path, prefix + ".valid.txt")
-    test_path = os.path.join(data_path, prefix + ".test.txt")
-
-    word_to_id, id_2_word = _build_vocab(train_path)
-    train_data = _file_to_word_ids(train_path, word_to_id)
-    valid_data = _file_to_word_ids(valid_path, word_to_id)
-    test_data = _file_to_word_ids(test_path, word_to_id)
-    return train_data, valid_data, test_data, word_to_id, id_2_word
-
-# Yields minibatches of data
-def ptb_iterator(raw_data, batch_size, num_steps):
-    raw_data = np.array(raw_data, dtype=np.int32)
-
-    data_len = len(raw_data)
-    batch_len = data_len // batch_size
-    data = np.zeros([batch_size, batch_len], dtype=np.int32)
-    for i in range(batch_size):
-        data[i] = raw_data[batch_len * i:batch_len * (i + 1)]
-
-    epoch_size = (batch_len - 1) // num_steps
-
-    if epoch_size == 0:
-        raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
-
-    for i in range(epoch_size):
-        x = data[:, i*num_steps:(i+1)*num_steps]
-        y = data[:, i*num_steps+1:(i+1)*num_steps+1]
-        yield (x, y)
-
-
 class Batch:
     "Data processing for the transformer. This class adds a mask to the data."
     def __init__(self, x, pad=-1):
@@ -261,23 +276,18 @@ class Batch:
     
     @staticmethod
     def make_mask(data, pad):
-        "Create a mask to hide future words."
-
-        def subsequent_mask(size):
-            """ helper function for creating the masks. """
-            attn_shape = (1, size, size)
-            subsequent_mask = np.triu(np.ones(attn_shape), k=1).astype('uint8')
-            return torch.from_numpy(subsequent_mask) == 0
-
-        mask = (data != pad).unsqueeze(-2)
-        mask = mask & Variable(
-            subsequent_mask(data.size(-1)).type_as(mask.data))
-        return mask
+        "Create a mask to hide future words. See models.Batch.make_mask"
+        return models.Batch.make_mask(data, pad)
 
 
 # LOAD DATA
 print('Loading data from '+args.data)
-raw_data = ptb_raw_data(data_path=args.data)
+if args.no_cache:
+    cache_dir = None
+else:
+    cache_dir = args.cache_dir or os.path.join(args.data, '.cache')
+prefix = 'ptb.char' if args.char else 'ptb'
+raw_data = ptb_raw_data(data_path=args.data, prefix=prefix, cache_dir=cache_dir)
 train_data, valid_data, test_data, word_to_id, id_2_word = raw_data
 vocab_size = len(word_to_id)
 print('  vocabulary size: {}'.format(vocab_size))
@@ -293,16 +303,29 @@ print('  vocabulary size: {}'.format(vocab_size))
 # This is where your model code will be called. You may modify this code
 # if required for your implementation, but it should not typically be necessary,
 # and you must let the TAs know if you do so.
+if args.adaptive_softmax and args.char:
+    # the character vocabulary is smaller than the cutoffs
+    print("--adaptive_softmax is ignored with --char")
+    adaptive_cutoffs = None
+elif args.adaptive_softmax and args.model != 'TRANSFORMER':
+    adaptive_cutoffs = [int(c) for c in args.adaptive_cutoffs.split(',')]
+else:
+    adaptive_cutoffs = None
+
 if args.model == 'RNN':
     model = RNN(emb_size=args.emb_size, hidden_size=args.hidden_size, 
                 seq_len=args.seq_len, batch_size=args.batch_size,
                 vocab_size=vocab_size, num_layers=args.num_layers, 
-                dp_keep_prob=args.dp_keep_prob) 
+                dp_keep_prob=args.dp_keep_prob, layer_major=args.layer_major,
+                adaptive_cutoffs=adaptive_cutoffs, 
+                checkpoint_steps=args.checkpoint_steps if args.checkpoint else 0) 
 elif args.model == 'GRU':
     model = GRU(emb_size=args.emb_size, hidden_size=args.hidden_size, 
                 seq_len=args.seq_len, batch_size=args.batch_size,
                 vocab_size=vocab_size, num_layers=args.num_layers, 
-                dp_keep_prob=args.dp_keep_prob)
+                dp_keep_prob=args.dp_keep_prob, layer_major=args.layer_major,
+                adaptive_cutoffs=adaptive_cutoffs, 
+                checkpoint_steps=args.checkpoint_steps if args.checkpoint else 0)
 elif args.model == 'TRANSFORMER':
     if args.debug:  # use a very small model
         model = TRANSFORMER(vocab_size=vocab_size, n_units=16, n_blocks=2)
@@ -312,7 +335,9 @@ elif args.model == 'TRANSFORMER':
         # Also, the Transformer also has other hyperparameters 
         # (such as the number of attention heads) which can change it's behavior.
         model = TRANSFORMER(vocab_size=vocab_size, n_units=args.hidden_size, 
-                            n_blocks=args.num_layers, dropout=1.-args.dp_keep_prob) 
+                            n_blocks=args.num_layers, dropout=1.-args.dp_keep_prob,
+                            attention_block_size=args.attention_block_size or None,
+                            checkpoint_blocks=args.checkpoint) 
     # these 3 attributes don't affect the Transformer's computations; 
     # they are only used in run_epoch
     model.batch_size=args.batch_size
@@ -325,13 +350,43 @@ model = model.to(device)
 
 # LOSS FUNCTION
 loss_fn = nn.CrossEntropyLoss()
+
+# The loss is computed by loss_head from the final hidden states for the
+# transformer, whose forward applies a log_softmax that loss_fn would redo,
+# and with --loss_chunk_size or a vocabulary no larger than the hidden size
+# (e.g. --char): chunked_cross_entropy then computes small vocabularies'
+# logits at once.
+if adaptive_cutoffs is None:
+    output_fc = model.output_layer if args.model == 'TRANSFORMER' else model.output_layer.fc
+    small_vocab = output_fc.out_features <= output_fc.in_features
+else:
+    small_vocab = False
+loss_from_hidden = args.model == 'TRANSFORMER' or args.loss_chunk_size > 0 or small_vocab
+
+def loss_head(outputs, tt):
+    """
+    Cross-entropy from the final hidden states (used for the transformer, with
+    --loss_chunk_size, small vocabularies, or --adaptive_softmax when training).
+    With --loss_chunk_size, the full logits of large vocabularies are never
+    materialized.
+    """
+    if adaptive_cutoffs is not None:
+        return model.output_layer.loss(outputs, tt)
+    if args.model == 'TRANSFORMER':
+        if args.loss_chunk_size <= 0:
+            # the logits, without the log_softmax of FullTransformer.forward
+            return F.cross_entropy(model.output_layer(outputs).reshape(-1, model.vocab_size), tt)
+        return chunked_cross_entropy(outputs, model.output_layer.weight, 
+                                     model.output_layer.bias, tt, args.loss_chunk_size)
+    return model.output_layer.chunked_loss(outputs, tt, args.loss_chunk_size)
+
 if args.optimizer == 'ADAM':
     optimizer = torch.optim.Adam(model.parameters(), lr=args.initial_lr)
 
 # LEARNING RATE SCHEDULE    
 lr = args.initial_lr
-lr_decay_base = 1 / 1.15
-m_flat_lr = 14.0 # we will not touch lr for the first m_flat_lr epochs
+# we will not touch lr for the first m_flat_lr=14 epochs, then decay it by 1.15 ** (epoch - 14)
+lr_schedule = LRSchedule(lr, decay_base=1 / 1.15, m_flat_lr=14.0)
 
 
 ###############################################################################
@@ -358,64 +413,218 @@ def repackage_hidden(h):
         return tuple(repackage_hidden(v) for v in h)
 
 
-def run_epoch(model, data, is_train=False, lr=1.0):
+class StepTimer:
+    """
+    Total time of training steps, by key (the window length with
+    --variable_bptt), without waiting for the device at every step: on the
+    GPU the steps are bracketed by CUDA events, which are only read by
+    seconds(), once the loop is over. On the CPU, the work is done when
+    start/stop are called, and time.time() is used.
+    """
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.steps = collections.defaultdict(list)
+
+    def start(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.time()
+
+    def stop(self, key, start):
+        if self.cuda:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self.steps[key].append((start, end))
+        else:
+            self.steps[key].append(time.time() - start)
+
+    def count(self, key):
+        return len(self.steps[key])
+
+    def seconds(self, key):
+        if self.cuda:
+            torch.cuda.synchronize()
+            return sum(start.elapsed_time(end) for start, end in self.steps[key]) / 1000.
+        return sum(self.steps[key])
+
+
+# The corpus splits, batched on device once (see ptb_reader.batchify),
+# keyed by (split, batch_size)
+batched_data = {}
+
+def get_batches(data, split, batch_size):
+    key = (split, batch_size)
+    if key not in batched_data:
+        batched_data[key] = batchify(data, batch_size, None if args.host_data else device)
+    return batched_data[key]
+
+def get_remainder(data, split, batch_size):
+    "The tokens that get_batches drops, see ptb_reader.batch_remainder."
+    key = (split, batch_size, 'remainder')
+    if key not in batched_data:
+        batched_data[key] = batch_remainder(data, batch_size, None if args.host_data else device)
+    return batched_data[key]
+
+
+def evaluate(model, data, batch_size=None, split='valid'):
+    """
+    Validation/test over a whole split (named split, e.g. 'valid' or 'test'),
+    under torch.inference_mode so that no graph is built. The models take
+    their shapes from their inputs, so batch_size (default: --eval_batch_size,
+    or model.batch_size) can be larger than the training one. The hidden
+    states are carried over the whole split, and the tokens left after the
+    last full minibatch are also evaluated, as are the ones that do not fill
+    a row of the batches (in a final single-row pass, which continues the last
+    row), so that the perplexity does not depend on batch_size.
+
+    Returns the perplexity over all the evaluated tokens, and the running total
+    of the costs after each step, as run_epoch (in tokens per row).
+    """
+    model.eval()
+    batch_size = batch_size or args.eval_batch_size or model.batch_size
+    parts = [get_batches(data, split, batch_size)]
+    remainder = get_remainder(data, split, batch_size)
+    if remainder is not None:
+        parts.append(remainder)
+    # the loss of each step times its number of tokens, divided by batch_size
+    step_costs = []
+    iters = 0
+    with torch.inference_mode():
+        if args.model != 'TRANSFORMER':
+            hidden = model.init_hidden(batch_size).to(device)
+        for batches in parts:
+            if args.model != 'TRANSFORMER' and batches.size(1) < hidden.size(1):
+                # the remainder follows the last row
+                hidden = hidden[:, -batches.size(1):]
+            minibatches = ptb_tensor_iterator(batches, model.seq_len, device, prefetch=args.prefetch,
+                                              keep_tail=True)
+            for x, y in minibatches:
+                tt = y.reshape(-1)
+                if args.model == 'TRANSFORMER':
+                    batch = Batch(x.t())
+                    if loss_from_hidden:
+                        outputs = model.forward_hidden(batch.data, batch.mask).transpose(1,0)
+                    else:
+                        outputs = model.forward(batch.data, batch.mask).transpose(1,0)
+                elif loss_from_hidden:
+                    outputs, hidden = model.forward_hidden(x, hidden)
+                else:
+                    outputs, hidden = model(x, hidden)
+                if loss_from_hidden:
+                    loss = loss_head(outputs, tt)
+                else:
+                    loss = loss_fn(outputs.reshape(-1, model.vocab_size), tt)
+                step_costs.append(loss.double() * x.numel() / batch_size)
+                iters += x.numel() / batch_size
+    losses = torch.stack(step_costs).cumsum(0).cpu().numpy()
+    return np.exp(losses[-1] / iters), losses
+
+
+def run_epoch(model, data, is_train=False, lr=1.0, batch_size=None, split=None):
     """
     One epoch of training/validation (depending on flag is_train).
+    Validation is done by evaluate, with batch_size (default: --eval_batch_size).
+    split names data for get_batches (default: 'train' or 'valid', following
+    is_train).
     """
-    if is_train:
-        model.train()
+    if not is_train:
+        return evaluate(model, data, batch_size, split or 'valid')
+    model.train()
+    batch_size = batch_size or model.batch_size
+    batches = get_batches(data, split or 'train', batch_size)
+    lengths = None
+    if is_train and args.variable_bptt:
+        lengths = random_bptt_lengths(batches.size(0) - 1, model.seq_len)
+        epoch_size = len(lengths)
     else:
-        model.eval()
-    epoch_size = ((len(data) // model.batch_size) - 1) // model.seq_len
+        epoch_size = ((len(data) // batch_size) - 1) // model.seq_len
+    # the time spent per window length, reported with --variable_bptt
+    window_timer = StepTimer(device) if lengths is not None else None
     start_time = time.time()
     if args.model != 'TRANSFORMER':
-        hidden = model.init_hidden()
+        hidden = model.init_hidden(batch_size)
         hidden = hidden.to(device)
-    costs = 0.0
+    # the loss of each step times its length, accumulated on device so that
+    # the host only waits for the GPU when logging
+    step_costs = torch.zeros(epoch_size + 1, dtype=torch.float64, device=device)
+    log_every = max(epoch_size // 10, 1)
     iters = 0
-    losses = []
+    # whether the loss is computed by loss_head from the final hidden states
+    hidden_loss = loss_from_hidden or (adaptive_cutoffs is not None and is_train)
 
     # LOOP THROUGH MINIBATCHES
-    for step, (x, y) in enumerate(ptb_iterator(data, model.batch_size, model.seq_len)):
+    # x and y are (seq_len, batch_size) views of the batched corpus, already on device
+    minibatches = ptb_tensor_iterator(batches, model.seq_len, device, prefetch=args.prefetch,
+                                      lengths=lengths)
+    for step, (x, y) in enumerate(minibatches):
+        if window_timer is not None:
+            step_start = window_timer.start()
         if args.model == 'TRANSFORMER':
-            batch = Batch(torch.from_numpy(x).long().to(device))
+            batch = Batch(x.t())
             model.zero_grad()
-            outputs = model.forward(batch.data, batch.mask).transpose(1,0)
+            if hidden_loss:
+                # the hidden states go to the loss head directly, with no log_softmax
+                outputs = model.forward_hidden(batch.data, batch.mask).transpose(1,0)
+            else:
+                outputs = model.forward(batch.data, batch.mask).transpose(1,0)
             #print ("outputs.shape", outputs.shape)
         else:
-            inputs = torch.from_numpy(x.astype(np.int64)).transpose(0, 1).contiguous().to(device)#.cuda()
+            inputs = x
             model.zero_grad()
             hidden = repackage_hidden(hidden)
-            outputs, hidden = model(inputs, hidden)
+            if hidden_loss:
+                outputs, hidden = model.forward_hidden(inputs, hidden)
+            else:
+                outputs, hidden = model(inputs, hidden)
 
-        targets = torch.from_numpy(y.astype(np.int64)).transpose(0, 1).contiguous().to(device)#.cuda()
-        tt = torch.squeeze(targets.view(-1, model.batch_size * model.seq_len))
+        tt = y.reshape(-1)
 
         # LOSS COMPUTATION
         # This line currently averages across all the sequences in a mini-batch 
         # and all time-steps of the sequences.
         # For problem 5.3, you will (instead) need to compute the average loss 
         #at each time-step separately. 
-        loss = loss_fn(outputs.contiguous().view(-1, model.vocab_size), tt)
-        costs += loss.data.item() * model.seq_len
-        losses.append(costs)
-        iters += model.seq_len
+        if hidden_loss:
+            loss = loss_head(outputs, tt)
+        else:
+            loss = loss_fn(outputs.contiguous().view(-1, model.vocab_size), tt)
+        # with --variable_bptt, minibatches are not all seq_len long
+        step_costs[step] = loss.detach().double() * x.size(0)
+        iters += x.size(0)
         if args.debug:
             print(step, loss)
         if is_train:  # Only update parameters if training 
             loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
+            # the loss is a mean over the window, so shorter windows get a
+            # smaller step (this is lr unless --variable_bptt)
+            step_lr = lr * x.size(0) / model.seq_len
             if args.optimizer == 'ADAM':
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
+                if lengths is not None:
+                    for group in optimizer.param_groups:
+                        group['lr'] = args.initial_lr * x.size(0) / model.seq_len
                 optimizer.step()
             else: 
-                for p in model.parameters():
-                    if p.grad is not None:
-                        p.data.add_(-lr, p.grad.data)
-            if step % (epoch_size // 10) == 10:
+                # clipping and update in one multi-tensor pass
+                clipped_sgd_step(model.parameters(), step_lr, 0.25)
+            if window_timer is not None:
+                window_timer.stop(x.size(0), step_start)
+            if step % log_every == 10:
+                costs = step_costs[:step + 1].sum().item()
                 print('step: '+ str(step) + '\t' \
                     + 'loss: '+ str(costs) + '\t' \
-                    + 'speed (wps):' + str(iters * model.batch_size / (time.time() - start_time)))
-    return np.exp(costs / iters), losses
+                    + 'speed (wps):' + str(iters * batch_size / (time.time() - start_time)))
+    if window_timer is not None:
+        print('window length\tsteps\tspeed (wps)')
+        for length in sorted(window_timer.steps):
+            steps = window_timer.count(length)
+            tokens = steps * length * batch_size
+            print(str(length) + '\t' + str(steps) + '\t' + str(tokens / window_timer.seconds(length)))
+    # losses is the running total of the costs after each step
+    losses = step_costs[:step + 1].cumsum(0).cpu().numpy()
+    return np.exp(losses[-1] / iters), losses
 
 
 
@@ -432,6 +641,42 @@ val_ppls = []
 val_losses = []
 best_val_so_far = np.inf
 times = []
+first_epoch = 0
+
+# checkpoints are serialized by a background thread, from CPU copies
+writer = AsyncCheckpointWriter(args.save_dir, keep=args.keep_snapshots)
+
+def training_state(epoch):
+    "Everything needed to resume after epoch."
+    return {'epoch': epoch,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict() if args.optimizer == 'ADAM' else None,
+            'lr': lr,
+            'rng_state': torch.get_rng_state(),
+            'cuda_rng_state': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            'train_ppls': train_ppls, 'val_ppls': val_ppls,
+            'train_losses': train_losses, 'val_losses': val_losses,
+            'best_val_so_far': best_val_so_far, 'times': times}
+
+if args.resume:
+    snapshot = latest_snapshot(args.save_dir)
+    if snapshot is None:
+        print("No snapshot in " + args.save_dir + ", starting from scratch")
+    else:
+        print("Resuming from " + snapshot)
+        state = torch.load(snapshot, map_location=device, weights_only=False)
+        model.load_state_dict(state['model'])
+        if state['optimizer'] is not None:
+            optimizer.load_state_dict(state['optimizer'])
+        # the hidden states are not saved: run_epoch starts each epoch from init_hidden
+        lr = lr_schedule.lr = state['lr']
+        torch.set_rng_state(state['rng_state'])
+        if state['cuda_rng_state'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['cuda_rng_state'])
+        train_ppls, val_ppls = state['train_ppls'], state['val_ppls']
+        train_losses, val_losses = state['train_losses'], state['val_losses']
+        best_val_so_far, times = state['best_val_so_far'], state['times']
+        first_epoch = state['epoch'] + 1
 
 # In debug mode, only run one epoch
 if args.debug:
@@ -440,49 +685,60 @@ else:
     num_epochs = args.num_epochs
 
 # MAIN LOOP
-for epoch in range(num_epochs):
-    t0 = time.time()
-    print('\nEPOCH '+str(epoch)+' ------------------')
-    if args.optimizer == 'SGD_LR_SCHEDULE':
-        lr_decay = lr_decay_base ** max(epoch - m_flat_lr, 0)
-        lr = lr * lr_decay # decay lr if it is time
-
-    # RUN MODEL ON TRAINING DATA
-    train_ppl, train_loss = run_epoch(model, train_data, True, lr)
-
-    # RUN MODEL ON VALIDATION DATA
-    val_ppl, val_loss = run_epoch(model, valid_data)
-
-
-    # SAVE MODEL IF IT'S THE BEST SO FAR
-    if val_ppl < best_val_so_far:
-        best_val_so_far = val_ppl
-        if args.save_best:
-            print("Saving model parameters to best_params.pt")
-            torch.save(model.state_dict(), os.path.join(args.save_dir, 'best_params.pt'))
-        # NOTE ==============================================
-        # You will need to load these parameters into the same model
-        # for a couple Problems: so that you can compute the gradient 
-        # of the loss w.r.t. hidden state as required in Problem 5.2
-        # and to sample from the the model as required in Problem 5.3
-        # We are not asking you to run on the test data, but if you 
-        # want to look at test performance you would load the saved
-        # model and run on the test data with batch_size=1
-
-    # LOC RESULTS
-    train_ppls.append(train_ppl)
-    val_ppls.append(val_ppl)
-    train_losses.extend(train_loss)
-    val_losses.extend(val_loss)
-    times.append(time.time() - t0)
-    log_str = 'epoch: ' + str(epoch) + '\t' \
-            + 'train ppl: ' + str(train_ppl) + '\t' \
-            + 'val ppl: ' + str(val_ppl)  + '\t' \
-            + 'best val: ' + str(best_val_so_far) + '\t' \
-            + 'time (s) spent in epoch: ' + str(times[-1])
-    print(log_str)
-    with open (os.path.join(args.save_dir, 'log.txt'), 'a') as f_:
-        f_.write(log_str+ '\n')
+try:
+    for epoch in range(first_epoch, num_epochs):
+        t0 = time.time()
+        print('\nEPOCH '+str(epoch)+' ------------------')
+        if args.optimizer == 'SGD_LR_SCHEDULE':
+            lr = lr_schedule.step(epoch) # decay lr if it is time
+
+        # RUN MODEL ON TRAINING DATA
+        train_ppl, train_loss = run_epoch(model, train_data, True, lr)
+
+        # RUN MODEL ON VALIDATION DATA
+        val_ppl, val_loss = run_epoch(model, valid_data)
+
+
+        # SAVE MODEL IF IT'S THE BEST SO FAR
+        if val_ppl < best_val_so_far:
+            best_val_so_far = val_ppl
+            if args.save_best:
+                print("Saving model parameters to best_params.pt")
+                writer.save(model.state_dict(), os.path.join(args.save_dir, 'best_params.pt'))
+            # NOTE ==============================================
+            # You will need to load these parameters into the same model
+            # for a couple Problems: so that you can compute the gradient 
+            # of the loss w.r.t. hidden state as required in Problem 5.2
+            # and to sample from the the model as required in Problem 5.3
+            # We are not asking you to run on the test data, but if you 
+            # want to look at test performance you would load the saved
+            # model and run on the test data with batch_size=1
+
+        # LOC RESULTS
+        train_ppls.append(train_ppl)
+        val_ppls.append(val_ppl)
+        train_losses.extend(train_loss)
+        val_losses.extend(val_loss)
+        times.append(time.time() - t0)
+        log_str = 'epoch: ' + str(epoch) + '\t' \
+                + 'train ppl: ' + str(train_ppl) + '\t' \
+                + 'val ppl: ' + str(val_ppl)  + '\t' \
+                + 'best val: ' + str(best_val_so_far) + '\t'
+        if args.char:
+            # bits per character = log2 of the perplexity
+            log_str += 'train bpc: ' + str(np.log2(train_ppl)) + '\t' \
+                    + 'val bpc: ' + str(np.log2(val_ppl)) + '\t'
+        log_str += 'time (s) spent in epoch: ' + str(times[-1])
+        print(log_str)
+        with open (os.path.join(args.save_dir, 'log.txt'), 'a') as f_:
+            f_.write(log_str+ '\n')
+
+        # SAVE A SNAPSHOT TO RESUME FROM
+        if args.snapshot_every > 0 and (epoch + 1) % args.snapshot_every == 0:
+            writer.save_snapshot(training_state(epoch), epoch)
+finally:
+    # wait for the pending checkpoints, also when training fails
+    writer.close()
 
 # SAVE LEARNING CURVES
 lc_path = os.path.join(args.save_dir, 'learning_curves.npy')
@@ -1,5 +1,4 @@
 import time
-import collections
 import os
 import sys
 import torch
@@ -10,67 +9,8 @@ import numpy as np
 
 from models import RNN, GRU
 from models import make_model as TRANSFORMER
-
-# HELPER FUNCTIONS
-
-
-def _read_words(filename):
-    with open(filename, "r") as f:
-        return f.read().replace("\n", "<eos>").split()
-
-
-def _build_vocab(filename):
-    data = _read_words(filename)
-
-    counter = collections.Counter(data)
-    count_pairs = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
-
-    words, _ = list(zip(*count_pairs))
-    word_to_id = dict(zip(words, range(len(words))))
-    id_to_word = dict((v, k) for k, v in word_to_id.items())
-
-    return word_to_id, id_to_word
-
-
-def _file_to_word_ids(filename, word_to_id):
-    data = _read_words(filename)
-    return [word_to_id[word] for word in data if word in word_to_id]
-
-# Processes the raw data from text files
-
-
-def ptb_raw_data(data_path=None, prefix="ptb"):
-    train_path = os.path.join(data_path, prefix + ".train.txt")
-    valid_path = os.path.join(data_path, prefix + ".valid.txt")
-    test_path = os.path.join(data_path, prefix + ".test.txt")
-
-    word_to_id, id_2_word = _build_vocab(train_path)
-    train_data = _file_to_word_ids(train_path, word_to_id)
-    valid_data = _file_to_word_ids(valid_path, word_to_id)
-    test_data = _file_to_word_ids(test_path, word_to_id)
-    return train_data, valid_data, test_data, word_to_id, id_2_word
-
-# Yields minibatches of data
-
-
-def ptb_iterator(raw_data, batch_size, num_steps):
-    raw_data = np.array(raw_data, dtype=np.int32)
-
-    data_len = len(raw_data)
-    batch_len = data_len // batch_size
-    data = np.zeros([batch_size, batch_len], dtype=np.int32)
-    for i in range(batch_size):
-        data[i] = raw_data[batch_len * i:batch_len * (i + 1)]
-
-    epoch_size = (batch_len - 1) // num_steps
-
-    if epoch_size == 0:
-        raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
-
-    for i in range(epoch_size):
-        x = data[:, i * num_steps:(i + 1) * num_steps]
-        y = data[:, i * num_steps + 1:(i + 1) * num_steps + 1]
-        yield (x, y)
+from models import speculative_generate, transformer_sizes
+from ptb_reader import ptb_raw_data
 
 
 class Batch:
@@ -98,27 +38,56 @@ class Batch:
 
 # LOAD DATA
 print('Loading data from ' + 'data')
-raw_data = ptb_raw_data(data_path='data')
+raw_data = ptb_raw_data(data_path='data', cache_dir=os.path.join('data', '.cache'))
 train_data, valid_data, test_data, word_to_id, id_2_word = raw_data
 vocab_size = len(word_to_id)
 print('  vocabulary size: {}'.format(vocab_size))
 
 
-def load_model(model_type, device, seq_len=35, batch_size=20, hidden_size=1500, num_layers=2, saved_model=None):
+# the models take their shapes from their inputs, so one model per saved_model
+# can generate any number of samples of any length
+loaded_models = {}
+
+
+def load_model(model_type, device, seq_len=35, batch_size=20, hidden_size=None, num_layers=None, saved_model=None):
+    """
+    hidden_size and num_layers default to 1500 and 2 for the RNN/GRU. For the
+    TRANSFORMER, they are read from saved_model (n_units and n_blocks), or
+    default to 512 and 6.
+    """
+    key = (model_type, hidden_size, num_layers, saved_model)
+    if key in loaded_models:
+        return loaded_models[key]
+
+    state_dict = None
+    if saved_model is not None:
+        state_dict = torch.load(saved_model, map_location=device)
+    if model_type == 'TRANSFORMER':
+        saved_sizes = transformer_sizes(state_dict) if state_dict is not None else (512, 6)
+        hidden_size = hidden_size or saved_sizes[0]
+        num_layers = num_layers or saved_sizes[1]
+    else:
+        hidden_size = hidden_size or 1500
+        num_layers = num_layers or 2
+
     if model_type == 'RNN':
-        model = RNN(emb_size=200, hidden_size=1500,
+        model = RNN(emb_size=200, hidden_size=hidden_size,
                     seq_len=seq_len, batch_size=batch_size,
-                    vocab_size=vocab_size, num_layers=2,
+                    vocab_size=vocab_size, num_layers=num_layers,
                     dp_keep_prob=0.35)
     if model_type == 'GRU':
-        model = GRU(emb_size=200, hidden_size=1500,
+        model = GRU(emb_size=200, hidden_size=hidden_size,
                     seq_len=seq_len, batch_size=batch_size,
-                    vocab_size=vocab_size, num_layers=2,
+                    vocab_size=vocab_size, num_layers=num_layers,
                     dp_keep_prob=0.35)
+    if model_type == 'TRANSFORMER':
+        model = TRANSFORMER(vocab_size=vocab_size, n_units=hidden_size,
+                            n_blocks=num_layers, dropout=1. - 0.9)
     model = model.to(device)
 
-    if saved_model is not None:
-        model.load_state_dict(torch.load(saved_model, map_location=device))
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
+    loaded_models[key] = model
     return model
 
 
@@ -134,16 +103,22 @@ else:
     device = torch.device("cpu")
 
 
-def generate_samples(model_type, saved_model_path, generated_seq_len, num_samples, hidden_size, num_layers):
+def generate_samples(model_type, saved_model_path, generated_seq_len, num_samples, hidden_size, num_layers,
+                     **sampling):
+    # sampling: temperature, top_k and top_p, see models.sample_logits
     # initial token
     x = np.random.choice(vocab_size, (1, num_samples))
     inputs = torch.from_numpy(x.astype(np.int64)).transpose(0, 1).contiguous().to(device)
-    model = load_model(model_type, device, seq_len=generated_seq_len, batch_size=num_samples, hidden_size=hidden_size,
+    model = load_model(model_type, device, hidden_size=hidden_size,
                        num_layers=num_layers, saved_model=saved_model_path)
     model.eval()
     model.zero_grad()
-    hidden = model.init_hidden().to(device)
-    gen_samples = model.generate(inputs, hidden, generated_seq_len - 1)
+    if model_type == 'TRANSFORMER':
+        # inputs is (num_samples, 1): a batch of one-token prompts
+        gen_samples = model.generate(inputs, generated_seq_len - 1, **sampling)
+    else:
+        hidden = model.init_hidden(num_samples).to(device)
+        gen_samples = model.generate(inputs, hidden, generated_seq_len - 1, **sampling)
     if use_gpu == 1:
         sample_words = [' '.join([id_2_word[t] for t in seq]) for seq in gen_samples.cpu().numpy().T]
     else:
@@ -151,8 +126,45 @@ def generate_samples(model_type, saved_model_path, generated_seq_len, num_sample
     return sample_words
 
 
+def beam_search_samples(model_type, saved_model_path, max_len, num_samples, hidden_size, num_layers,
+                        beam_size=5, length_penalty=1.0):
+    # the most likely continuation of random initial tokens, up to the first <eos>
+    x = np.random.choice(vocab_size, (num_samples,))
+    inputs = torch.from_numpy(x.astype(np.int64)).to(device)
+    model = load_model(model_type, device, hidden_size=hidden_size,
+                       num_layers=num_layers, saved_model=saved_model_path)
+    model.eval()
+    hidden = model.init_hidden(num_samples).to(device)
+    gen_samples, _ = model.beam_search(inputs, hidden, max_len, beam_size=beam_size,
+                                       eos_id=word_to_id['<eos>'], length_penalty=length_penalty)
+    sample_words = []
+    for seq in gen_samples.cpu().numpy().T:
+        words = [id_2_word[t] for t in seq]
+        if '<eos>' in words[1:]:
+            words = words[:words.index('<eos>', 1) + 1]
+        sample_words.append(' '.join(words))
+    return sample_words
 
-# RNN
+def speculative_samples(draft_path, draft_hidden_size, draft_num_layers, saved_model_path, generated_seq_len,
+                        num_samples, hidden_size, num_layers, k=4):
+    # samples of the GRU of saved_model_path, drafted k tokens at a time by the
+    # (smaller) RNN of draft_path; see models.speculative_generate
+    x = np.random.choice(vocab_size, (num_samples,))
+    inputs = torch.from_numpy(x.astype(np.int64)).to(device)
+    draft = load_model('RNN', device, hidden_size=draft_hidden_size,
+                       num_layers=draft_num_layers, saved_model=draft_path)
+    target = load_model('GRU', device, hidden_size=hidden_size,
+                        num_layers=num_layers, saved_model=saved_model_path)
+    draft.eval()
+    target.eval()
+    gen_samples, acceptance = speculative_generate(
+        draft, target, inputs, draft.init_hidden(num_samples).to(device),
+        target.init_hidden(num_samples).to(device), generated_seq_len - 1, k=k)
+    print('accepted draft tokens: %.1f%%' % (100 * acceptance))
+    return [' '.join([id_2_word[t] for t in seq]) for seq in gen_samples.cpu().numpy().T]
+
+
+# RNN, GRU or TRANSFORMER
 model_type = "GRU"
 # use the model from 4.1
 # saved_model_path = "4.1_exp/RNN_ADAM_model=RNN_optimizer=ADAM_initial_lr=0.0001_batch_size=20_seq_len=35_hidden_size=1500_num_layers=2_dp_keep_prob=0.35_save_best_0/best_params.pt"
@@ -169,8 +181,21 @@ saved_model_path = "GRU/best_params.pt"
 
 num_samples = 10
 generated_seq_len = 35
-hidden_size = 1500
-num_layers = 2
-RNN_samples_1 = generate_samples(model_type, saved_model_path, generated_seq_len, num_samples, hidden_size, num_layers)
+# None uses the defaults of load_model (1500 and 2 for the RNN/GRU, the sizes
+# of the checkpoint for the TRANSFORMER)
+hidden_size = None
+num_layers = None
+# "sample" for ancestral sampling, "beam" for beam search (RNN and GRU only),
+# or "speculative" for samples of the GRU drafted by a small RNN
+decoding = "sample"
+draft_model_path = "RNN_small/best_params.pt"
+if decoding == "speculative":
+    RNN_samples_1 = speculative_samples(draft_model_path, 200, 2, saved_model_path, generated_seq_len,
+                                        num_samples, hidden_size, num_layers, k=4)
+elif decoding == "beam":
+    RNN_samples_1 = beam_search_samples(model_type, saved_model_path, generated_seq_len - 1, num_samples,
+                                        hidden_size, num_layers, beam_size=5)
+else:
+    RNN_samples_1 = generate_samples(model_type, saved_model_path, generated_seq_len, num_samples, hidden_size, num_layers)
 for i in RNN_samples_1:
     print(i + "\n")
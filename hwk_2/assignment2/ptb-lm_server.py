@@ -0,0 +1,345 @@
+#!/bin/python
+# coding: utf-8
+
+# A long-running generation server for the Penn Treebank language models.
+#
+# Unlike ptb-lm_generate.py, which loads the vocabulary and a model on every
+# run, this loads them once and serves generation requests over HTTP (or a
+# Unix socket). Concurrent requests are coalesced into shared batches: a batch
+# is run once max_batch_size requests are waiting, or max_wait_ms after the
+# first one arrived. Requests are only batched with requests of the same
+# prompt length and sampling options.
+#
+# Usage:
+#    python ptb-lm_server.py --model_type=GRU --saved_model=GRU/best_params.pt --hidden_size=1500 --port=8000
+#    python ptb-lm_server.py --model_type=TRANSFORMER --saved_model=TRANSFORMER/best_params.pt
+#    python ptb-lm_server.py --model_type=GRU --saved_model=GRU/best_params.pt --unix_socket=/tmp/ptb-lm.sock
+#
+# Endpoints:
+#    POST /generate  {"prompt": "the stock", "length": 35, "temperature": 1.0,
+#                     "top_k": 0, "top_p": 1.0}
+#                    -> {"text": "the stock market ...", "tokens": 35}
+#                    "prompt" is optional (a random word by default); words
+#                    outside the vocabulary are replaced by <unk>. temperature
+#                    must be > 0, top_k >= 0 and top_p in (0, 1].
+#    POST /score     {"sentences": ["<eos> the stock market", ...]}
+#                    -> {"log_probs": [...], "token_log_probs": [[...], ...]}
+#                    the first word of each sentence is only used as context,
+#                    see scoring.score_sequences
+#    GET /stats      -> latency percentiles (ms), tokens/sec and batch sizes
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import time
+import numpy as np
+import torch
+
+from models import RNN, GRU
+from models import make_model as TRANSFORMER
+from models import transformer_sizes
+from ptb_reader import ptb_raw_data
+from scoring import score_sequences
+
+parser = argparse.ArgumentParser(description='Generation server for the PTB language models')
+parser.add_argument('--data', type=str, default='data',
+                    help='location of the data corpus (for the vocabulary)')
+parser.add_argument('--model_type', type=str, default='GRU',
+                    help='type of the saved model (RNN, GRU, TRANSFORMER)')
+parser.add_argument('--saved_model', type=str, default='GRU/best_params.pt',
+                    help='path of the saved parameters')
+parser.add_argument('--emb_size', type=int, default=200,
+                    help='size of word embeddings (RNN/GRU)')
+parser.add_argument('--hidden_size', type=int, default=None,
+                    help='size of hidden layers (default: 1500), or n_units of the \
+                    TRANSFORMER (default: read from saved_model)')
+parser.add_argument('--num_layers', type=int, default=None,
+                    help='number of hidden layers (default: 2), or of TRANSFORMER \
+                    blocks (default: read from saved_model)')
+parser.add_argument('--host', type=str, default='127.0.0.1',
+                    help='address to listen on')
+parser.add_argument('--port', type=int, default=8000,
+                    help='port to listen on')
+parser.add_argument('--unix_socket', type=str, default='',
+                    help='listen on this Unix socket instead of host:port')
+parser.add_argument('--max_batch_size', type=int, default=64,
+                    help='maximum number of requests generated together')
+parser.add_argument('--max_wait_ms', type=float, default=10.,
+                    help='how long the first request of a batch waits for others')
+parser.add_argument('--max_length', type=int, default=1000,
+                    help='maximum number of generated tokens per request')
+parser.add_argument('--score_token_budget', type=int, default=4096,
+                    help='maximum number of tokens per batch when scoring sentences')
+
+
+def load_model(args, vocab_size, device):
+    state_dict = torch.load(args.saved_model, map_location=device)
+    if args.model_type == 'TRANSFORMER':
+        n_units, n_blocks = transformer_sizes(state_dict)
+        hidden_size = args.hidden_size or n_units
+        num_layers = args.num_layers or n_blocks
+    else:
+        hidden_size = args.hidden_size or 1500
+        num_layers = args.num_layers or 2
+    if args.model_type == 'RNN':
+        model = RNN(emb_size=args.emb_size, hidden_size=hidden_size,
+                    seq_len=35, batch_size=1, vocab_size=vocab_size,
+                    num_layers=num_layers, dp_keep_prob=1.)
+    elif args.model_type == 'GRU':
+        model = GRU(emb_size=args.emb_size, hidden_size=hidden_size,
+                    seq_len=35, batch_size=1, vocab_size=vocab_size,
+                    num_layers=num_layers, dp_keep_prob=1.)
+    elif args.model_type == 'TRANSFORMER':
+        model = TRANSFORMER(vocab_size=vocab_size, n_units=hidden_size,
+                            n_blocks=num_layers, dropout=0.)
+    else:
+        raise ValueError("Model type not recognized: " + args.model_type)
+    model.load_state_dict(state_dict)
+    model = model.to(device)
+    model.eval()
+    return model
+
+
+Request = collections.namedtuple('Request', ['prompt', 'length', 'sampling', 'future', 'start_time'])
+
+
+class Stats:
+    "Latencies of the last requests, and generation throughput since the start."
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.requests = 0
+        self.tokens = 0
+        self.busy_time = 0.
+        self.start_time = time.time()
+
+    def report(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = {}
+        if len(latencies):
+            for p in [50, 90, 99]:
+                percentiles['p%d' % p] = float(np.percentile(latencies, p))
+        elapsed = time.time() - self.start_time
+        return {'requests': self.requests,
+                'tokens': self.tokens,
+                'latency_ms': percentiles,
+                # while generating, and over the lifetime of the server
+                'tokens_per_sec': self.tokens / self.busy_time if self.busy_time else 0.,
+                'tokens_per_sec_wall': self.tokens / elapsed if elapsed else 0.,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.}
+
+
+class GenerationServer:
+    """
+    Coalesces generation requests into batches, and runs them one batch at a
+    time in a worker thread, so that the event loop keeps accepting requests.
+    """
+    def __init__(self, model, model_type, word_to_id, id_2_word, device,
+                 max_batch_size=64, max_wait_ms=10., max_length=1000, score_token_budget=4096):
+        self.model = model
+        self.model_type = model_type
+        self.word_to_id = word_to_id
+        self.id_2_word = id_2_word
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.max_length = max_length
+        self.score_token_budget = score_token_budget
+        self.stats = Stats()
+        # requests waiting to be batched, by (prompt length, sampling options)
+        self.waiting = collections.defaultdict(list)
+        self.new_request = asyncio.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def tokenize(self, prompt):
+        if not prompt:
+            return [int(np.random.choice(len(self.word_to_id)))]
+        unk = self.word_to_id.get('<unk>', 0)
+        return [self.word_to_id.get(word, unk) for word in prompt.split()]
+
+    async def generate(self, prompt, length=35, temperature=1.0, top_k=0, top_p=1.0):
+        "Returns the prompt followed by length sampled words."
+        length = max(1, min(int(length), self.max_length))
+        temperature, top_k, top_p = float(temperature), int(top_k), float(top_p)
+        # answered with a 400 by route, instead of sampling from NaN or -inf logits
+        if not temperature > 0:
+            raise ValueError('temperature must be > 0')
+        if top_k < 0:
+            raise ValueError('top_k must be >= 0')
+        if not 0 < top_p <= 1:
+            raise ValueError('top_p must be in (0, 1]')
+        sampling = (('temperature', temperature), ('top_k', top_k), ('top_p', top_p))
+        tokens = self.tokenize(prompt)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[(len(tokens), sampling)].append(
+            Request(tokens, length, sampling, future, time.time()))
+        self.new_request.set()
+        return await future
+
+    def score(self, sentences):
+        "Log-probabilities of a list of sentences (worker thread)."
+        sequences = [self.tokenize(sentence) for sentence in sentences]
+        seq_log_probs, token_log_probs = score_sequences(self.model, sequences,
+                                                         self.score_token_budget, self.device)
+        return {'log_probs': seq_log_probs.tolist(),
+                'token_log_probs': [t.tolist() for t in token_log_probs]}
+
+    async def batcher(self):
+        "Starts a batch when one is full, or when its oldest request waited max_wait."
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.waiting:
+                self.new_request.clear()
+                await self.new_request.wait()
+            key, requests = min(self.waiting.items(), key=lambda item: item[1][0].start_time)
+            wait = requests[0].start_time + self.max_wait - time.time()
+            if len(requests) < self.max_batch_size and wait > 0:
+                self.new_request.clear()
+                try:
+                    await asyncio.wait_for(self.new_request.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch = requests[:self.max_batch_size]
+            if len(requests) > self.max_batch_size:
+                self.waiting[key] = requests[self.max_batch_size:]
+            else:
+                del self.waiting[key]
+            # requests whose client went away are cancelled, and not generated
+            batch = [request for request in batch if not request.future.done()]
+            if not batch:
+                continue
+            try:
+                texts = await loop.run_in_executor(self.executor, self.run_batch, batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            now = time.time()
+            for request, text in zip(batch, texts):
+                # a request cancelled while its batch ran must not stop the loop
+                if request.future.done():
+                    continue
+                try:
+                    self.stats.latencies.append(now - request.start_time)
+                    request.future.set_result(text)
+                except Exception as e:
+                    request.future.set_exception(e)
+
+    def run_batch(self, batch):
+        "Generates the whole batch at once, up to its longest request (worker thread)."
+        start_time = time.time()
+        sampling = dict(batch[0].sampling)
+        length = max(request.length for request in batch)
+        # (prompt_len, batch_size)
+        prompts = torch.tensor([request.prompt for request in batch], dtype=torch.long, device=self.device).t()
+        with torch.inference_mode():
+            if self.model_type == 'TRANSFORMER':
+                samples = self.model.generate(prompts.t(), length, **sampling)
+            else:
+                hidden = self.model.init_hidden(len(batch)).to(self.device)
+                if prompts.size(0) > 1:
+                    # run the prompt but its last word, which starts the generation
+                    _, hidden = self.model.forward_hidden(prompts[:-1], hidden)
+                samples = self.model.generate(prompts[-1], hidden, length, **sampling)
+                samples = torch.cat([prompts[:-1], samples])
+        samples = samples.cpu().numpy().T
+        texts = []
+        for request, seq in zip(batch, samples):
+            seq = seq[:len(request.prompt) + request.length]
+            texts.append(' '.join(self.id_2_word[t] for t in seq))
+            self.stats.tokens += request.length
+        self.stats.requests += len(batch)
+        self.stats.batch_sizes.append(len(batch))
+        self.stats.busy_time += time.time() - start_time
+        return texts
+
+    async def handle_connection(self, reader, writer):
+        "A minimal HTTP/1.1 front end, with keep-alive."
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.route(method, path, body)
+                payload = json.dumps(response).encode()
+                writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json\r\n'
+                              'Content-Length: %d\r\n\r\n' % (status, len(payload))).encode() + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return '200 OK', self.stats.report()
+        if method == 'POST' and path == '/generate':
+            try:
+                params = json.loads(body or b'{}')
+                text = await self.generate(params.get('prompt', ''), params.get('length', 35),
+                                           params.get('temperature', 1.0), params.get('top_k', 0),
+                                           params.get('top_p', 1.0))
+            except (ValueError, TypeError, AttributeError) as e:
+                return '400 Bad Request', {'error': str(e)}
+            except Exception as e:
+                return '500 Internal Server Error', {'error': str(e)}
+            return '200 OK', {'text': text, 'tokens': len(text.split())}
+        if method == 'POST' and path == '/score':
+            try:
+                sentences = json.loads(body or b'{}')['sentences']
+                if not all(isinstance(sentence, str) and sentence for sentence in sentences):
+                    raise ValueError('sentences must be non-empty strings')
+            except (ValueError, TypeError, KeyError) as e:
+                return '400 Bad Request', {'error': str(e)}
+            # the sentences of a request are already batched by score_sequences
+            loop = asyncio.get_running_loop()
+            try:
+                return '200 OK', await loop.run_in_executor(self.executor, self.score, sentences)
+            except Exception as e:
+                return '500 Internal Server Error', {'error': str(e)}
+        return '404 Not Found', {'error': 'unknown endpoint ' + method + ' ' + path}
+
+
+async def main(args):
+    if torch.cuda.is_available():
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+    print('Loading vocabulary from ' + args.data)
+    _, _, _, word_to_id, id_2_word = ptb_raw_data(data_path=args.data, cache_dir=os.path.join(args.data, '.cache'))
+    print('Loading ' + args.model_type + ' from ' + args.saved_model)
+    model = load_model(args, len(word_to_id), device)
+
+    server = GenerationServer(model, args.model_type, word_to_id, id_2_word, device,
+                              args.max_batch_size, args.max_wait_ms, args.max_length,
+                              args.score_token_budget)
+    batcher = asyncio.ensure_future(server.batcher())
+    if args.unix_socket:
+        listener = await asyncio.start_unix_server(server.handle_connection, path=args.unix_socket)
+        print('Listening on ' + args.unix_socket)
+    else:
+        listener = await asyncio.start_server(server.handle_connection, args.host, args.port)
+        print('Listening on http://%s:%d' % (args.host, args.port))
+    async with listener:
+        await listener.serve_forever()
+    batcher.cancel()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,354 @@
+# Data loading for the Penn Treebank language modeling scripts
+# (ptb-lm.py and ptb-lm_generate.py).
+#
+# based on code from:
+#    https://github.com/deeplearningathome/pytorch-language-model/blob/master/reader.py
+#
+# Tokenizing the corpus and building the vocabulary takes a few seconds, so
+# ptb_raw_data keeps a binary cache of the result: one int32 .npy file of
+# token ids per split and the vocabulary (one word per line, in id order),
+# under a directory named after a hash of the source files. Later runs load
+# the token ids with np.load(mmap_mode='r'), so parallel jobs on the same
+# machine share one page-cached copy.
+#
+# The cache is built in two streaming passes over the text (one for the
+# vocabulary, one for the token ids), so corpora larger than RAM can be used.
+#
+# The character-level splits (prefix="ptb.char") have one space-separated
+# token per character, so they go through the same tokenizer; their
+# vocabulary is small enough for the token ids to be stored as uint8.
+
+import collections
+import hashlib
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import numpy as np
+import torch
+
+SPLITS = ['train', 'valid', 'test']
+
+
+# HELPER FUNCTIONS
+def _iter_word_chunks(filename, chunk_size=1 << 20):
+    """
+    Yields the words of filename as lists, reading chunk_size characters at a
+    time, so that the whole text is never held in memory. The words are the
+    same as those of _read_words: a word cut by the end of a chunk is carried
+    over to the next one.
+    """
+    tail = ""
+    with open(filename, "r") as f:
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+            text = tail + chunk.replace("\n", "<eos>")
+            words = text.split()
+            tail = ""
+            if words and not text[-1].isspace():
+                tail = words.pop()
+            yield words
+    if tail:
+        yield [tail]
+
+
+def _read_words(filename):
+    return [word for words in _iter_word_chunks(filename) for word in words]
+
+
+def _build_vocab(filename):
+    # first pass: only the word counts are kept in memory
+    counter = collections.Counter()
+    for words in _iter_word_chunks(filename):
+        counter.update(words)
+    count_pairs = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
+
+    words, _ = list(zip(*count_pairs))
+    word_to_id = dict(zip(words, range(len(words))))
+    id_to_word = dict((v, k) for k, v in word_to_id.items())
+
+    return word_to_id, id_to_word
+
+
+def _file_to_word_ids(filename, word_to_id):
+    data = _read_words(filename)
+    return [word_to_id[word] for word in data if word in word_to_id]
+
+
+def _ids_dtype(vocab_size):
+    "The smallest dtype used to store token ids: uint8 for character-level vocabularies."
+    return np.uint8 if vocab_size <= 256 else np.int32
+
+
+def _write_word_ids(filename, word_to_id, path, dtype=np.int32):
+    """
+    Second pass: streams the ids of the words of filename to a .npy file of
+    dtype at path. The ids go to a temporary file first, as the length of the
+    array (in the .npy header) is only known at the end.
+    """
+    count = 0
+    with tempfile.TemporaryFile(dir=os.path.dirname(path)) as raw:
+        for words in _iter_word_chunks(filename):
+            ids = np.fromiter((word_to_id[word] for word in words if word in word_to_id), dtype=dtype)
+            raw.write(ids.tobytes())
+            count += len(ids)
+        raw.seek(0)
+        with open(path, "wb") as f:
+            header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                      'fortran_order': False, 'shape': (count,)}
+            np.lib.format.write_array_header_1_0(f, header)
+            shutil.copyfileobj(raw, f, 1 << 20)
+
+
+def _hash_files(paths):
+    "A hash of the contents of the files, used to name the cache."
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()[:16]
+
+
+def _load_cache(cache_path):
+    splits = [np.load(os.path.join(cache_path, split + ".npy"), mmap_mode='r') for split in SPLITS]
+    with open(os.path.join(cache_path, "vocab.txt"), "r") as f:
+        words = f.read().split("\n")
+    word_to_id = dict(zip(words, range(len(words))))
+    id_to_word = dict(enumerate(words))
+    return splits + [word_to_id, id_to_word]
+
+
+def _write_cache(cache_path, paths, word_to_id, id_to_word):
+    # write everything to a temporary directory and rename it, so that other
+    # jobs never see a partial cache
+    parent = os.path.dirname(cache_path)
+    if not os.path.exists(parent):
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    os.chmod(tmp_path, 0o755)
+    dtype = _ids_dtype(len(word_to_id))
+    for split, path in zip(SPLITS, paths):
+        _write_word_ids(path, word_to_id, os.path.join(tmp_path, split + ".npy"), dtype)
+    with open(os.path.join(tmp_path, "vocab.txt"), "w") as f:
+        f.write("\n".join(id_to_word[i] for i in range(len(id_to_word))))
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another job wrote the same cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+# Processes the raw data from text files
+def ptb_raw_data(data_path=None, prefix="ptb", cache_dir=None):
+    """
+    Returns train_data, valid_data, test_data, word_to_id, id_2_word.
+
+    prefix="ptb.char" loads the character-level splits instead of the words.
+
+    If cache_dir is given, the token ids are loaded from (or saved to) a cache
+    in that directory, and are returned as read-only memory-mapped arrays
+    instead of lists: uint8 for vocabularies of at most 256 tokens, int32
+    otherwise. Building the cache streams the text files, so that its memory
+    use is bounded by the size of the vocabulary rather than that of the
+    corpus: this is the way to load corpora larger than PTB.
+    """
+    paths = [os.path.join(data_path, prefix + "." + split + ".txt") for split in SPLITS]
+    train_path, valid_path, test_path = paths
+
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, prefix + "-" + _hash_files(paths))
+        if not os.path.exists(cache_path):
+            word_to_id, id_2_word = _build_vocab(train_path)
+            _write_cache(cache_path, paths, word_to_id, id_2_word)
+        return tuple(_load_cache(cache_path))
+
+    word_to_id, id_2_word = _build_vocab(train_path)
+    train_data = _file_to_word_ids(train_path, word_to_id)
+    valid_data = _file_to_word_ids(valid_path, word_to_id)
+    test_data = _file_to_word_ids(test_path, word_to_id)
+    return train_data, valid_data, test_data, word_to_id, id_2_word
+
+
+# Yields minibatches of data
+def ptb_iterator(raw_data, batch_size, num_steps):
+    raw_data = np.array(raw_data, dtype=np.int32)
+
+    data_len = len(raw_data)
+    batch_len = data_len // batch_size
+    data = np.zeros([batch_size, batch_len], dtype=np.int32)
+    for i in range(batch_size):
+        data[i] = raw_data[batch_len * i:batch_len * (i + 1)]
+
+    epoch_size = (batch_len - 1) // num_steps
+
+    if epoch_size == 0:
+        raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
+
+    for i in range(epoch_size):
+        x = data[:, i*num_steps:(i+1)*num_steps]
+        y = data[:, i*num_steps+1:(i+1)*num_steps+1]
+        yield (x, y)
+
+
+def batchify(raw_data, batch_size, device=None):
+    """
+    Cuts the token stream into batch_size contiguous rows, once, and returns
+    them as a (batch_len, batch_size) int64 tensor on device: column i is the
+    i-th row of ptb_iterator, and the tensor is time-major like the inputs of
+    the RNN/GRU, so every minibatch is a contiguous view of it.
+    uint8 token ids (character-level vocabularies) stay uint8, 8 times smaller;
+    ptb_tensor_iterator converts each minibatch to int64.
+    Tensors kept on the CPU for a CUDA model are pinned, so that the minibatches
+    can be copied asynchronously (see ptb_tensor_iterator).
+    The last len(raw_data) % batch_size tokens are dropped (see batch_remainder).
+    """
+    batch_len = len(raw_data) // batch_size
+    dtype = np.uint8 if getattr(raw_data, 'dtype', None) == np.uint8 else np.int64
+    # a copy, as memory-mapped caches are read-only
+    data = np.array(raw_data[:batch_size * batch_len], dtype=dtype)
+    data = torch.from_numpy(data).view(batch_size, batch_len).t().contiguous()
+    if device is not None:
+        data = data.to(device)
+    elif torch.cuda.is_available():
+        data = data.pin_memory()
+    return data
+
+
+def batch_remainder(raw_data, batch_size, device=None):
+    """
+    The tokens that batchify(raw_data, batch_size) drops (at most
+    batch_size - 1), preceded by the last token it keeps, as a
+    (remainder + 1, 1) tensor like the ones of batchify: the remainder
+    continues the last column, so it can be evaluated after it. Returns
+    None if nothing is dropped.
+    """
+    start = batch_size * (len(raw_data) // batch_size) - 1
+    if start < 0 or start + 1 >= len(raw_data):
+        return None
+    return batchify(raw_data[start:], 1, device)
+
+
+def _prefetch(iterator, size):
+    """
+    Runs iterator in a background thread, at most size items ahead. If the
+    consumer stops early (break, exception, or the generator being closed),
+    the thread stops at its next item instead of blocking forever.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # False once the consumer is gone
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(end)
+
+    threading.Thread(target=worker, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def _same_device(a, b):
+    "Whether devices a and b are the same, e.g. 'cuda' and 'cuda:0' when 0 is the current device."
+    a, b = torch.device(a), torch.device(b)
+    if a.type != b.type:
+        return False
+    if a.index is None or b.index is None:
+        if a.type != 'cuda':
+            return True
+        current = torch.cuda.current_device()
+        return (current if a.index is None else a.index) == (current if b.index is None else b.index)
+    return a.index == b.index
+
+
+def random_bptt_lengths(total, num_steps, p=0.95, std=5., min_steps=5):
+    """
+    Random BPTT window lengths covering total time-steps (as in Merity et al.,
+    2017, https://arxiv.org/abs/1708.02182): each window is centered on
+    num_steps with probability p, on num_steps / 2 otherwise, with a normal
+    jitter of standard deviation std, and at least min_steps long. The last
+    window is cut to fit. Uses the torch random number generator.
+    """
+    lengths = []
+    start = 0
+    while start < total:
+        mean = num_steps if torch.rand(()).item() < p else num_steps / 2.
+        length = max(min_steps, int(round(torch.normal(float(mean), float(std), ()).item())))
+        length = min(length, total - start)
+        lengths.append(length)
+        start += length
+    return lengths
+
+
+# Yields minibatches of data, as views of a tensor from batchify
+def ptb_tensor_iterator(data, num_steps, device=None, prefetch=0, keep_tail=False, lengths=None):
+    """
+    Same minibatches as ptb_iterator, but x and y are (num_steps, batch_size)
+    int64 views of data, with no copy when data is already on device (uint8
+    data is converted to int64 one minibatch at a time).
+
+    If data is on another device than device (e.g. pinned host memory for a
+    CUDA model), each minibatch is copied with non_blocking=True. With
+    prefetch > 0, minibatches are prepared by a background thread, up to
+    prefetch minibatches ahead.
+
+    With keep_tail=True, the tokens left after the last full minibatch are
+    yielded as a final, shorter minibatch instead of being dropped.
+
+    lengths, if given, are the lengths of the successive minibatches (e.g.
+    from random_bptt_lengths(data.size(0) - 1, num_steps)), instead of
+    num_steps each.
+    """
+    batch_len = data.size(0)
+
+    if lengths is None:
+        epoch_size = (batch_len - 1) // num_steps
+        lengths = [num_steps] * epoch_size
+        if keep_tail and epoch_size * num_steps < batch_len - 1:
+            lengths.append(batch_len - 1 - epoch_size * num_steps)
+
+    if not lengths:
+        raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
+
+    copy = device is not None and not _same_device(data.device, device)
+    starts = np.cumsum([0] + list(lengths[:-1])).tolist()
+
+    def minibatches():
+        for start, length in zip(starts, lengths):
+            end = min(start + length, batch_len - 1)
+            x = data[start:end]
+            y = data[start+1:end+1]
+            if copy:
+                x = x.to(device, non_blocking=True)
+                y = y.to(device, non_blocking=True)
+            if data.dtype != torch.int64:
+                x, y = x.long(), y.long()
+            yield (x, y)
+
+    if prefetch > 0:
+        return _prefetch(minibatches(), prefetch)
+    return minibatches()
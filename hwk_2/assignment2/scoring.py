@@ -0,0 +1,102 @@
+# Log-likelihoods of separate token sequences (e.g. sentences, or candidate
+# lists to rescore) under the PTB language models of models.py.
+#
+# Unlike run_epoch in ptb-lm.py, which cuts one contiguous token stream into
+# (batch_size, seq_len) tiles, this scores each sequence on its own: the
+# sequences are sorted by length and packed into right-padded batches of at
+# most token_budget tokens, so that few of the computed positions are padding.
+
+import torch
+import torch.nn.functional as F
+
+from models import Batch, RNN, GRU
+
+
+def length_buckets(lengths, token_budget):
+    """
+    Groups the indices of sequences of the given lengths into batches of
+    similar lengths: the indices are sorted by decreasing length, and a batch
+    is closed when one more sequence would make it (rows x longest length)
+    larger than token_budget. A sequence longer than token_budget gets its own
+    batch.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # the first sequence of a batch is its longest
+        if batch and (len(batch) + 1) * lengths[batch[0]] > token_budget:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def score_sequences(model, sequences, token_budget=4096, device=None):
+    """
+    Log-probabilities of token sequences under model (a RNN, GRU or
+    FullTransformer), under inference mode.
+
+    Each sequence is scored independently, from zero hidden states for the
+    RNN/GRU: its first token is only used as context (start sentences with
+    <eos> to score all their words), and token t is scored given tokens 0..t-1.
+    For the transformer, the padding is masked with the pad argument of Batch,
+    as an id above every token id of sequences.
+
+    inputs:
+        model: the model, which is put in eval mode
+        sequences: a list of lists of token ids, of any lengths
+        token_budget (int): the maximum number of (padded) tokens per batch
+        device: the device of model (default: the one of its parameters)
+
+    returns:
+        the log-probability of each sequence (the sum over its tokens),
+            a tensor of shape (len(sequences)), on the CPU
+        the log-probabilities of the tokens of each sequence after the
+            first, a list of tensors of shape (len(sequence) - 1), on the CPU
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    model.eval()
+    lengths = [len(seq) for seq in sequences]
+    seq_log_probs = torch.zeros(len(sequences), dtype=torch.float64)
+    token_log_probs = [torch.zeros(max(n - 1, 0)) for n in lengths]
+    # marks padding in the batches given to Batch.make_mask, which ignores
+    # negative pads; replaced by a real token id before the embedding (padded
+    # positions are never scored)
+    pad = 1 + max((max(seq) for seq in sequences if len(seq) > 0), default=0)
+
+    with torch.inference_mode():
+        for batch in length_buckets(lengths, token_budget):
+            max_len = lengths[batch[0]]
+            if max_len < 2:
+                # nothing left to score
+                continue
+            # (batch, max_len), right-padded with pad
+            data = torch.full((len(batch), max_len), pad, dtype=torch.long)
+            for row, i in enumerate(batch):
+                data[row, :lengths[i]] = torch.as_tensor(sequences[i], dtype=torch.long)
+            data = data.to(device)
+            inputs = data.masked_fill(data == pad, 0)
+
+            if isinstance(model, (RNN, GRU)):
+                # padding only comes after the real tokens, so it never affects them
+                hidden = model.init_hidden(len(batch)).to(device)
+                logits, _ = model(inputs[:, :-1].t(), hidden)
+                logits = logits.transpose(0, 1)
+            else:
+                batch_data = Batch(data[:, :-1], pad=pad)
+                logits = model(inputs[:, :-1], batch_data.mask)
+            # (batch, max_len - 1) log-probabilities of the next tokens; for the
+            # transformer and the adaptive softmax, the outputs already are
+            # log-probabilities, which log_softmax leaves unchanged
+            log_probs = F.log_softmax(logits.float(), dim=-1)
+            log_probs = log_probs.gather(2, inputs[:, 1:].unsqueeze(-1)).squeeze(-1)
+            log_probs = log_probs.masked_fill(data[:, 1:] == pad, 0.).cpu()
+
+            for row, i in enumerate(batch):
+                token_log_probs[i] = log_probs[row, :max(lengths[i] - 1, 0)].clone()
+            seq_log_probs[batch] = log_probs.double().sum(1)
+    return seq_log_probs, token_log_probs
@@ -0,0 +1,50 @@
+# Plain SGD for the Penn Treebank language modeling script (ptb-lm.py):
+# the update of the SGD and SGD_LR_SCHEDULE optimizers, and the learning
+# rate schedule of SGD_LR_SCHEDULE.
+
+import torch
+
+
+def clipped_sgd_step(params, lr, max_norm):
+    """
+    Equivalent to torch.nn.utils.clip_grad_norm_(params, max_norm) followed by
+    p.data.add_(-lr, p.grad.data) for every parameter, but with multi-tensor
+    (torch._foreach_*) kernels over the whole parameter list: one pass for the
+    norms of the gradients, one for the update. The clipping coefficient stays
+    on the device (a 0-dim tensor, as accepted by torch._foreach_mul since
+    torch 2.1), so the step never waits for the GPU.
+
+    Unlike clip_grad_norm_, the gradients are not clipped in place: they are
+    left unmodified, and the clipping coefficient is folded into the step size.
+
+    inputs:
+        params: an iterable of parameters; those without a gradient are skipped
+        lr (float): the learning rate
+        max_norm (float): the maximum total (L2) norm of the gradients
+    """
+    params = [p for p in params if p.grad is not None]
+    if not params:
+        return
+    grads = [p.grad for p in params]
+    with torch.no_grad():
+        total_norm = torch.stack(torch._foreach_norm(grads)).norm()
+        # same coefficient as clip_grad_norm_, and 1 when no clipping is needed
+        clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+        torch._foreach_add_(params, torch._foreach_mul(grads, clip_coef * -lr))
+
+
+class LRSchedule:
+    """
+    The SGD_LR_SCHEDULE learning rate: lr is kept for the first m_flat_lr
+    epochs, then, at the start of each epoch, multiplied by
+    decay_base ** (epoch - m_flat_lr).
+    """
+    def __init__(self, lr, decay_base=1 / 1.15, m_flat_lr=14.0):
+        self.lr = lr
+        self.decay_base = decay_base
+        self.m_flat_lr = m_flat_lr
+
+    def step(self, epoch):
+        "Returns the learning rate of epoch (called once per epoch, in order)."
+        self.lr = self.lr * self.decay_base ** max(epoch - self.m_flat_lr, 0)
+        return self.lr
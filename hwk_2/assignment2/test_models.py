@@ -0,0 +1,375 @@
+# Checks of the optimized layers of models.py against their reference
+# implementations. Run with: python -m pytest test_models.py
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import models
+from models import (GRU, RNN, Batch, ChunkedCrossEntropy, GRUCell, Linear_Layer, MultiHeadedAttention,
+                    RNN_Hidden_Layer, causal_mask_bias, is_causal_mask_bias, make_model,
+                    sample_logits, speculative_generate, subsequent_mask)
+
+
+def recurrent_model(model_class, **kwargs):
+    "A small RNN or GRU without dropout, the same for every kwargs."
+    torch.manual_seed(0)
+    return model_class(emb_size=6, hidden_size=8, seq_len=7, batch_size=3, vocab_size=20,
+                       num_layers=3, dp_keep_prob=1., **kwargs)
+
+
+@pytest.mark.parametrize('model_class', [RNN, GRU])
+@pytest.mark.parametrize('variant', [{'layer_major': True}, {'checkpoint_steps': 3},
+                                     {'layer_major': True, 'checkpoint_steps': 3}])
+def test_recurrent_variants_match_timestep_major(model_class, variant):
+    reference = recurrent_model(model_class)
+    model = recurrent_model(model_class, **variant)
+    model.load_state_dict(reference.state_dict())
+    # train mode, so that checkpoint_steps takes effect
+    reference.train()
+    model.train()
+
+    inputs = torch.randint(0, 20, (7, 3))
+    hidden = torch.randn(3, 3, 8)
+    results = []
+    for m in [reference, model]:
+        h0 = hidden.clone().requires_grad_()
+        logits, h = m(inputs, h0)
+        loss = logits.logsumexp(-1).sum() + h.pow(2).sum()
+        # rnn_layer is only the template of the cloned layers, so it is unused
+        grads = torch.autograd.grad(loss, [h0] + list(m.parameters()), allow_unused=True)
+        results.append((logits, h, grads))
+
+    (logits_ref, h_ref, grads_ref), (logits, h, grads) = results
+    assert torch.allclose(logits, logits_ref, atol=1e-6)
+    assert torch.allclose(h, h_ref, atol=1e-6)
+    for g, g_ref in zip(grads, grads_ref):
+        assert (g is None) == (g_ref is None)
+        assert g is None or torch.allclose(g, g_ref, atol=1e-5)
+
+
+def attention_pair(block_size, n_heads=4, n_units=32):
+    "A dense MultiHeadedAttention and a blockwise one with the same weights, without dropout."
+    torch.manual_seed(0)
+    dense = MultiHeadedAttention(n_heads, n_units, dropout=0.)
+    blockwise = MultiHeadedAttention(n_heads, n_units, dropout=0., block_size=block_size)
+    blockwise.load_state_dict(dense.state_dict())
+    return dense, blockwise
+
+
+def check_attention(dense, blockwise, x, mask):
+    x_dense = x.clone().requires_grad_()
+    x_block = x.clone().requires_grad_()
+    out_dense = dense(x_dense, x_dense, x_dense, mask)
+    out_block = blockwise(x_block, x_block, x_block, mask)
+    assert torch.allclose(out_block, out_dense, atol=1e-5)
+
+    grad = torch.randn_like(out_dense)
+    out_dense.backward(grad)
+    out_block.backward(grad)
+    assert torch.allclose(x_block.grad, x_dense.grad, atol=1e-5)
+    for (name, p_dense), p_block in zip(dense.named_parameters(), blockwise.parameters()):
+        assert torch.allclose(p_block.grad, p_dense.grad, atol=1e-5), name
+
+
+def test_blockwise_attention_causal():
+    # 10 positions in tiles of 4: the last tiles are partial
+    dense, blockwise = attention_pair(block_size=4)
+    x = torch.randn(3, 10, 32)
+    check_attention(dense, blockwise, x, causal_mask_bias(10))
+
+
+def test_causal_mask_bias_is_one_cached_mask():
+    sizes = [5, 300, 7, 299]
+    masks = [causal_mask_bias(size) for size in sizes]
+    for size, mask in zip(sizes, masks):
+        assert mask.size() == (1, size, size)
+        assert torch.equal(mask == 0, subsequent_mask(size))
+    # one mask per (device, dtype), whatever the number of sizes
+    cpu_masks = [key for key in models._causal_mask_cache if key[0].type == 'cpu' and key[1] == torch.float32]
+    assert len(cpu_masks) == 1
+    # the masks returned after the cache last grew are recognized by the blockwise attention
+    assert is_causal_mask_bias(masks[2]) and is_causal_mask_bias(masks[3])
+    assert not is_causal_mask_bias(masks[2].clone())
+    assert not is_causal_mask_bias(Batch(torch.zeros(1, 7, dtype=torch.long), pad=0).mask)
+
+
+def test_blockwise_attention_padding_mask():
+    dense, blockwise = attention_pair(block_size=4)
+    # train mode: dropout=0 must give the same result as the dense attention
+    dense.train()
+    blockwise.train()
+    data = torch.randint(1, 20, (3, 10))
+    data[1, 7:] = 0
+    data[2, 3:] = 0
+    mask = Batch(data, pad=0).mask
+    assert mask.size() == (3, 10, 10)
+    check_attention(dense, blockwise, torch.randn(3, 10, 32), mask)
+
+
+def test_blockwise_attention_boolean_mask():
+    dense, blockwise = attention_pair(block_size=3)
+    mask = torch.ones(2, 7, 7, dtype=torch.bool)
+    mask[0, :, 5:] = False
+    check_attention(dense, blockwise, torch.randn(2, 7, 32), mask)
+
+
+def test_gru_cell_gradcheck():
+    torch.manual_seed(0)
+    cell = GRUCell(5, 4, p=0).double()
+    x = torch.randn(3, 5, dtype=torch.float64, requires_grad=True)
+    h = torch.randn(3, 4, dtype=torch.float64, requires_grad=True)
+    assert torch.autograd.gradcheck(cell, (x, h))
+
+
+def test_gru_cell_loads_per_gate_checkpoints():
+    # the layout of GRUCell before the gates were fused
+    torch.manual_seed(0)
+    old = nn.ModuleDict({'reset_gate': RNN_Hidden_Layer(5, 4, act='sigmoid'),
+                         'forget_gate': RNN_Hidden_Layer(5, 4, act='sigmoid'),
+                         'cell_state': RNN_Hidden_Layer(5, 4, act='tanh')})
+    cell = GRUCell(5, 4, p=0)
+    cell.load_state_dict(old.state_dict())
+
+    x, h = torch.randn(3, 5), torch.randn(3, 4)
+    r = old['reset_gate'](x, h)
+    z = old['forget_gate'](x, h)
+    c = old['cell_state'](x, r * h)
+    assert torch.allclose(cell(x, h), (1 - z) * h + z * c, atol=1e-6)
+
+
+def test_chunked_cross_entropy_gradcheck():
+    torch.manual_seed(0)
+    x = torch.randn(7, 4, dtype=torch.float64, requires_grad=True)
+    weight = torch.randn(10, 4, dtype=torch.float64, requires_grad=True)
+    bias = torch.randn(10, dtype=torch.float64, requires_grad=True)
+    targets = torch.randint(0, 10, (7,))
+    # 7 rows in chunks of 3: the last chunk is partial
+    assert torch.autograd.gradcheck(
+        lambda x, weight, bias: ChunkedCrossEntropy.apply(x, weight, bias, targets, 3),
+        (x, weight, bias))
+
+
+def test_chunked_loss_matches_cross_entropy():
+    # more words than hidden units, so the chunked path is taken
+    torch.manual_seed(0)
+    layer = Linear_Layer(8, 50, p=0)
+    x = torch.randn(5, 6, 8)
+    targets = torch.randint(0, 50, (5, 6))
+
+    loss = layer.chunked_loss(x, targets, chunk_size=4)
+    reference = F.cross_entropy(layer(x).view(-1, 50), targets.view(-1))
+    assert torch.allclose(loss, reference, atol=1e-6)
+
+    grad = torch.autograd.grad(loss, layer.parameters())
+    reference_grad = torch.autograd.grad(reference, layer.parameters())
+    for g, g_ref in zip(grad, reference_grad):
+        assert torch.allclose(g, g_ref, atol=1e-6)
+
+
+def small_transformer():
+    torch.manual_seed(0)
+    model = make_model(vocab_size=20, n_blocks=2, n_units=16, n_heads=4)
+    model.eval()
+    return model
+
+
+def test_cached_decoding_matches_full_forward():
+    model = small_transformer()
+    data = torch.randint(0, 20, (2, 9))
+    word_embedding, position = model.embedding[0], model.embedding[1]
+    with torch.no_grad():
+        full = model.forward_hidden(data, causal_mask_bias(9))
+
+        caches = [layer.self_attn.init_cache(2, 9, device=data.device)
+                  for layer in model.transformer_stack.layers]
+        # a prompt of 4 positions, then one position at a time
+        x = position(word_embedding(data[:, :4]))
+        steps = [model.transformer_stack(x, causal_mask_bias(4), caches)]
+        for t in range(4, 9):
+            x = position(word_embedding(data[:, t:t + 1]), offset=t)
+            steps.append(model.transformer_stack(x, None, caches))
+    assert torch.allclose(torch.cat(steps, dim=1), full, atol=1e-5)
+
+
+def test_generate_matches_greedy_decoding():
+    model = small_transformer()
+    prompt = torch.randint(0, 20, (2, 3))
+    samples = model.generate(prompt, 5, top_k=1)
+
+    # greedy decoding which re-runs the whole prefix at every step
+    seq = prompt
+    with torch.no_grad():
+        for _ in range(5):
+            log_probs = model(seq, causal_mask_bias(seq.size(1)))
+            seq = torch.cat([seq, log_probs[:, -1].argmax(-1, keepdim=True)], dim=1)
+    assert torch.equal(samples, seq.t())
+
+
+def test_attention_loads_separate_qkv_checkpoints():
+    # the layout of MultiHeadedAttention before Q_ll, K_ll and V_ll were fused
+    torch.manual_seed(0)
+    old = nn.ModuleDict({name: nn.Linear(16, 16) for name in ['Q_ll', 'K_ll', 'V_ll', 'Out_ll']})
+    attn = MultiHeadedAttention(4, 16, dropout=0.)
+    attn.load_state_dict(old.state_dict())
+
+    x = torch.randn(2, 5, 16)
+    q, k, v = [old[name](x).view(2, 5, 4, 4).transpose(1, 2) for name in ['Q_ll', 'K_ll', 'V_ll']]
+    s = F.softmax(torch.matmul(q, k.transpose(-2, -1)) / 2., dim=-1)
+    reference = old['Out_ll'](torch.matmul(s, v).transpose(1, 2).reshape(2, 5, 16))
+    assert torch.allclose(attn(x, x, x), reference, atol=1e-6)
+
+
+def test_sample_logits_greedy_settings_give_the_argmax():
+    torch.manual_seed(0)
+    logits = torch.randn(50, 10)
+    argmax = logits.argmax(-1)
+    for sampling in [{'top_k': 1}, {'top_p': 1e-6}, {'top_p': 0.}, {'temperature': 1e-4}]:
+        assert torch.equal(sample_logits(logits, **sampling), argmax), sampling
+
+
+def test_sample_logits_distribution():
+    torch.manual_seed(0)
+    logits = torch.tensor([2., 1., 0.5, 0., -1.])
+    probs = F.softmax(logits, dim=-1)
+    n = 20000
+
+    def frequencies(**sampling):
+        samples = sample_logits(logits.expand(n, -1), **sampling)
+        return torch.bincount(samples, minlength=5).float() / n
+
+    assert torch.allclose(frequencies(), probs, atol=0.02)
+    sharp = F.softmax(logits / 0.5, dim=-1)
+    assert torch.allclose(frequencies(temperature=0.5), sharp, atol=0.02)
+    # only the 2 most likely tokens, renormalized
+    top_2 = torch.cat([F.softmax(logits[:2], dim=-1), torch.zeros(3)])
+    assert torch.allclose(frequencies(top_k=2), top_2, atol=0.02)
+    # the smallest set with a probability of at least 0.8
+    size = int((probs.cumsum(0) < 0.8).sum()) + 1
+    nucleus = torch.cat([F.softmax(logits[:size], dim=-1), torch.zeros(5 - size)])
+    assert torch.allclose(frequencies(top_p=0.8), nucleus, atol=0.02)
+
+
+def sequence_log_likelihood(model, seqs, eos_id=None):
+    """
+    The log-likelihood of seqs[1:] given seqs[0], for each column of seqs, up
+    to and including the first eos_id, and the number of tokens counted.
+    """
+    with torch.no_grad():
+        hidden = model.init_hidden(seqs.size(1))
+        logits, _ = model(seqs[:-1], hidden)
+        log_probs = F.log_softmax(logits, dim=-1).gather(2, seqs[1:].unsqueeze(-1)).squeeze(-1)
+    counted = torch.ones_like(log_probs, dtype=torch.bool)
+    if eos_id is not None:
+        # the tokens after the first eos_id are padding
+        after_eos = (seqs[1:] == eos_id).long().cumsum(0) - (seqs[1:] == eos_id).long()
+        counted = after_eos == 0
+    return (log_probs * counted).sum(0), counted.sum(0)
+
+
+@pytest.mark.parametrize('model_class', [RNN, GRU])
+def test_beam_search_of_size_1_is_greedy(model_class):
+    model = recurrent_model(model_class)
+    model.eval()
+    input = torch.randint(0, 20, (3,))
+    seqs, scores = model.beam_search(input, model.init_hidden(3), 6, beam_size=1)
+    assert torch.equal(seqs, model.generate(input, model.init_hidden(3), 6, top_k=1))
+    log_likelihood, length = sequence_log_likelihood(model, seqs)
+    assert torch.allclose(scores, log_likelihood / length, atol=1e-5)
+
+
+@pytest.mark.parametrize('model_class', [RNN, GRU])
+def test_beam_search_pads_finished_hypotheses(model_class):
+    model = recurrent_model(model_class)
+    model.eval()
+    # eos is likely enough that some hypotheses finish before max_len
+    with torch.no_grad():
+        model.output_layer.fc.bias[0] += 2.
+    input = torch.randint(0, 20, (8,))
+    seqs, scores = model.beam_search(input, model.init_hidden(8), 10, beam_size=3, eos_id=0)
+    is_eos = seqs[1:] == 0
+    first_eos = torch.where(is_eos.any(0), is_eos.long().argmax(0), torch.full((8,), 10))
+    assert bool((first_eos < seqs.size(0) - 2).any())
+    for column, first in enumerate(first_eos.tolist()):
+        assert bool(is_eos[first:, column].all())
+    log_likelihood, length = sequence_log_likelihood(model, seqs, eos_id=0)
+    assert torch.allclose(scores, log_likelihood / length, atol=1e-5)
+
+
+@pytest.mark.parametrize('model_class', [RNN, GRU])
+def test_beam_search_stops_once_all_hypotheses_are_finished(model_class):
+    model = recurrent_model(model_class)
+    model.eval()
+    with torch.no_grad():
+        model.output_layer.fc.bias[0] += 100.
+    input = torch.randint(0, 20, (4,))
+    seqs, scores = model.beam_search(input, model.init_hidden(4), 10, beam_size=3, eos_id=0)
+    # the best hypothesis emits eos at the first step; the two other ones
+    # take another token there and emit eos at the second step, so the
+    # search stops after 2 steps instead of 10
+    assert seqs.size() == (3, 4)
+    assert torch.equal(seqs[0], input) and bool((seqs[1:] == 0).all())
+    assert bool((scores > -1e-3).all())
+
+
+def speculative_pair():
+    "A draft RNN and a target GRU over 4 tokens, with quite different distributions."
+    torch.manual_seed(0)
+    draft = RNN(emb_size=4, hidden_size=6, seq_len=5, batch_size=1, vocab_size=4, num_layers=1, dp_keep_prob=1.)
+    target = GRU(emb_size=4, hidden_size=8, seq_len=5, batch_size=1, vocab_size=4, num_layers=2, dp_keep_prob=1.)
+    with torch.no_grad():
+        draft.output_layer.fc.bias.copy_(torch.tensor([0., 1., 1., -2.]))
+        target.output_layer.fc.bias.copy_(torch.tensor([2., 0., -1., 1.]))
+    return draft.eval(), target.eval()
+
+
+def test_speculative_generate_accepts_everything_from_the_target():
+    _, target = speculative_pair()
+    input = torch.zeros(16, dtype=torch.long)
+    hidden = target.init_hidden(16)
+    _, acceptance = speculative_generate(target, target, input, hidden, hidden, 9, k=3)
+    assert acceptance == 1.0
+
+
+def test_speculative_generate_samples_the_target_distribution():
+    draft, target = speculative_pair()
+    n = 20000
+    input = torch.zeros(n, dtype=torch.long)
+    torch.manual_seed(1)
+    samples, acceptance = speculative_generate(draft, target, input, draft.init_hidden(n),
+                                               target.init_hidden(n), 2, k=2)
+    assert acceptance < 1.0
+
+    # the exact distribution of the first two tokens under target
+    with torch.no_grad():
+        pairs = torch.cartesian_prod(torch.arange(4), torch.arange(4)).t()  # (2, 16)
+        seqs = torch.cat([torch.zeros(1, 16, dtype=torch.long), pairs])
+        log_likelihood, _ = sequence_log_likelihood(target, seqs)
+    exact = log_likelihood.exp()
+    empirical = torch.bincount(samples[1] * 4 + samples[2], minlength=16).float() / n
+    assert torch.allclose(empirical, exact, atol=0.015)
+    # and as sampled by target.generate
+    generated = target.generate(input, target.init_hidden(n), 2)
+    generated = torch.bincount(generated[1] * 4 + generated[2], minlength=16).float() / n
+    assert torch.allclose(empirical, generated, atol=0.02)
+
+
+@pytest.mark.parametrize('batch_size', [1, 5])
+@pytest.mark.parametrize('same_draft', [False, True])
+def test_speculative_generate_returns_the_hidden_states_of_its_tokens(batch_size, same_draft):
+    draft, target = speculative_pair()
+    if same_draft:
+        # every round keeps k + 1 = 5 tokens, so the second one is cut to 2
+        draft = target
+    input = torch.randint(0, 4, (batch_size,))
+    torch.manual_seed(2)
+    samples, _, target_hidden, draft_hidden = speculative_generate(
+        draft, target, input, draft.init_hidden(batch_size), target.init_hidden(batch_size), 7, k=4,
+        return_hidden=True)
+    assert samples.size() == (8, batch_size)
+    with torch.no_grad():
+        _, target_ref = target.forward_hidden(samples[:-1], target.init_hidden(batch_size))
+        _, draft_ref = draft.forward_hidden(samples[:-1], draft.init_hidden(batch_size))
+    assert torch.allclose(target_hidden, target_ref, atol=1e-5)
+    assert torch.allclose(draft_hidden, draft_ref, atol=1e-5)
@@ -0,0 +1,29 @@
+# Checks of ptb_reader.py. Run with: python -m pytest test_ptb_reader.py
+
+import pytest
+import torch
+
+from ptb_reader import batchify, batch_remainder, ptb_tensor_iterator
+
+
+def test_batch_remainder_continues_the_last_row():
+    data = list(range(23))
+    batches = batchify(data, 5)
+    remainder = batch_remainder(data, 5)
+    assert remainder.size() == (4, 1)
+    # the last kept token, then the 3 dropped ones
+    assert remainder[0, 0] == batches[-1, -1]
+    assert torch.equal(torch.cat([batches.t().reshape(-1), remainder[1:, 0]]), torch.arange(23))
+    assert batch_remainder(list(range(20)), 5) is None
+
+
+def test_keep_tail_yields_sequences_shorter_than_num_steps():
+    batches = batchify(list(range(12)), 3)
+    minibatches = list(ptb_tensor_iterator(batches, 35, keep_tail=True))
+    assert len(minibatches) == 1
+    x, y = minibatches[0]
+    assert torch.equal(x, batches[:-1]) and torch.equal(y, batches[1:])
+    with pytest.raises(ValueError):
+        ptb_tensor_iterator(batches, 35)
+    with pytest.raises(ValueError):
+        ptb_tensor_iterator(batchify(list(range(3)), 3), 35, keep_tail=True)
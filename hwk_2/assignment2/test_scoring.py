@@ -0,0 +1,45 @@
+# Checks of scoring.py. Run with: python -m pytest test_scoring.py
+
+import pytest
+import torch
+
+from models import GRU, RNN, make_model
+from scoring import length_buckets, score_sequences
+
+VOCAB_SIZE = 20
+
+
+def build_model(model_type):
+    torch.manual_seed(0)
+    if model_type == 'TRANSFORMER':
+        return make_model(vocab_size=VOCAB_SIZE, n_blocks=2, n_units=16, n_heads=4)
+    model_class = RNN if model_type == 'RNN' else GRU
+    return model_class(emb_size=8, hidden_size=16, seq_len=5, batch_size=2,
+                       vocab_size=VOCAB_SIZE, num_layers=2, dp_keep_prob=1.)
+
+
+def test_length_buckets():
+    lengths = [3, 8, 5, 5, 2, 20]
+    batches = length_buckets(lengths, token_budget=16)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    # the longest sequence gets its own batch
+    assert batches[0] == [5]
+    for batch in batches[1:]:
+        assert len(batch) * lengths[batch[0]] <= 16
+
+
+@pytest.mark.parametrize('model_type', ['RNN', 'GRU', 'TRANSFORMER'])
+def test_padded_batches_match_single_sequences(model_type):
+    model = build_model(model_type)
+    torch.manual_seed(1)
+    sequences = [torch.randint(0, VOCAB_SIZE, (n,)).tolist() for n in [7, 3, 12, 1, 5, 5, 9]]
+    # a small budget gives several batches, each with padded rows
+    seq_log_probs, token_log_probs = score_sequences(model, sequences, token_budget=24)
+
+    for i, seq in enumerate(sequences):
+        single_log_prob, single_tokens = score_sequences(model, [seq])
+        assert token_log_probs[i].size() == (len(seq) - 1,)
+        assert torch.allclose(token_log_probs[i], single_tokens[0], atol=1e-5)
+        assert torch.allclose(seq_log_probs[i], single_log_prob[0], atol=1e-5)
+    # a single token has nothing to score
+    assert seq_log_probs[3] == 0
@@ -0,0 +1,43 @@
+# Checks of sgd.py. Run with: python -m pytest test_sgd.py
+
+import pytest
+import torch
+
+from sgd import clipped_sgd_step, LRSchedule
+
+
+def params_with_grads(grad_scale):
+    torch.manual_seed(0)
+    params = [torch.nn.Parameter(torch.randn(shape)) for shape in [(5, 3), (3,), (4, 4, 2)]]
+    for p in params:
+        p.grad = grad_scale * torch.randn_like(p)
+    # a parameter without a gradient is skipped
+    params.append(torch.nn.Parameter(torch.randn(2)))
+    return params
+
+
+@pytest.mark.parametrize('grad_scale', [0.01, 10.])
+def test_clipped_sgd_step_matches_clip_grad_norm(grad_scale):
+    # small gradients are not clipped, large ones are
+    params = params_with_grads(grad_scale)
+    reference = params_with_grads(grad_scale)
+    grads = [p.grad.clone() for p in params[:-1]]
+
+    clipped_sgd_step(params, 0.5, 0.25)
+
+    # the previous update of ptb-lm.py
+    torch.nn.utils.clip_grad_norm_(reference, 0.25)
+    for p in reference:
+        if p.grad is not None:
+            p.data.add_(p.grad.data, alpha=-0.5)
+
+    for p, p_ref in zip(params, reference):
+        assert torch.allclose(p, p_ref, atol=1e-6)
+    # the gradients are not clipped in place
+    for p, grad in zip(params, grads):
+        assert torch.equal(p.grad, grad)
+
+
+def test_lr_schedule():
+    schedule = LRSchedule(20., decay_base=0.5, m_flat_lr=2)
+    assert [schedule.step(epoch) for epoch in range(5)] == [20., 20., 20., 10., 2.5]